@@ -0,0 +1,422 @@
+"""
+Headless entry point for the bulk jobs. Usage (from the project root, where the model file is):
+    python -m apis.cli score [--input FILE] [--output FILE] [--format jsonl|csv] [--snapshot FILE] < queries.jsonl
+        [--max-dots N] [--min-relative-weight X] - bound the number of the dots per query location
+    python -m apis.cli snapshot FILE [--data FILE] [--model FILE]
+    python -m apis.cli train --model FILE [--force] [--configurations FILE] [--dataset FILE] [--workers N] [--threads N]
+    python -m apis.cli archive CSV_FILE ARCHIVE_FILE [--block-size N]
+    python -m apis.cli extract ARCHIVE_FILE CSV_FILE
+Every input record is either a query location ({"latitude": ..., "longitude": ...}, optionally with "parking_time")
+    or an InsuranceInputData ({"bike_price": ..., "lock_type": "chain", ..., "user_risk_tendency": {...}}).
+The results are written as JSONL in the order of the input, the progress is reported on stderr.
+The metrics of the workers are collected by the parent and written to METRICS_OUTPUT, if it's set (see utils.metrics).
+The "snapshot" command saves the loaded data and the model weights into a single file,
+    which the "score" workers memory-map instead of reading the CSV and loading the model with TensorFlow.
+The "train" command trains the premium model with several configurations in parallel
+    (a JSON list of TrainingConfiguration arguments, the variations of the current architecture by default)
+    and saves the best model into the given file, an existing file is only replaced with --force.
+The "archive" and "extract" commands convert the parking locations between the CSV and the archive format
+    (see repository.parking_locations_archive).
+"""
+import sys
+import csv
+import json
+from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future
+from itertools import islice
+from math import isnan
+from multiprocessing import get_start_method
+from os import cpu_count, environ
+from os.path import exists
+from time import perf_counter
+from typing import Final, Iterable, Iterator, TextIO
+
+from repository import Location
+from repository.parking_locations_repository import ParkingLocationsSource, write_csv, has_user_id_column
+from repository.parking_locations_archive import ParkingLocationsArchive, write_archive, DEFAULT_BLOCK_SIZE
+from repository.insurance_premium_estimation_repository import (InsuranceInputData, UserRiskTendency, LockType,
+                                                                BikeType, FrameMaterial)
+from services.parking_locations_service import estimate_theft_probability, POWER_OF_DISTANCE
+from services.snapshot_service import create_snapshot, load_snapshot
+from services import insurance_premium_training_service as training
+from utils import metrics
+
+
+DEFAULT_CHUNK_SIZE: Final = 256
+PROGRESS_INTERVAL: Final = 5.0  # seconds
+RISK_TENDENCY_FIELDS: Final = (
+    "avg_theft_probability_prediction", "avg_theft_probability", "avg_recovery_probability_prediction",
+    "avg_recovery_probability", "avg_parking_time_theft_probability_prediction", "avg_parking_time"
+)
+
+
+class _InvalidRecord:
+    """A line of the input that can't be parsed, it gets an error in the output instead of stopping the job"""
+    def __init__(self, error: str):
+        self.error = error
+
+
+def _read_records(file: TextIO, input_format: str) -> Iterator[dict | _InvalidRecord]:
+    if input_format == "csv":
+        for row in csv.DictReader(file):
+            yield {key: value for key, value in row.items() if value not in ('', None)}
+    else:
+        for line in file:
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError as e:
+                    yield _InvalidRecord(f"{type(e).__name__}: {e}")
+
+
+def _to_bool(value) -> bool:
+    return value.lower() == "true" if isinstance(value, str) else bool(value)
+
+
+def _to_enum(enum_type, value):
+    """Enums are accepted both by name and by value"""
+    if isinstance(value, str) and not value.lstrip('-').isdigit():
+        return enum_type[value]
+    return enum_type(int(value))
+
+
+def _get_float(record: dict, *names: str) -> float | None:
+    for name in names:
+        if record.get(name) is not None:
+            return float(record[name])
+    return None
+
+
+def _get_required(record: dict, name: str):
+    if record.get(name) is None:
+        raise KeyError(f"The '{name}' field is required")
+    return record[name]
+
+
+def _parse_insurance_input_data(record: dict) -> InsuranceInputData:
+    """
+    The risk tendency may be nested (JSON) or flat (CSV columns).
+    All the fields the model needs are checked here, so that a bad record can't break the prediction of its chunk
+    """
+    risk_tendency = record.get("user_risk_tendency") or record
+    if not isinstance(risk_tendency, dict):
+        raise TypeError("The 'user_risk_tendency' field must be an object")
+    return InsuranceInputData(
+        bike_price=float(_get_required(record, "bike_price")),
+        lock_type=_to_enum(LockType, _get_required(record, "lock_type")),
+        bike_type=_to_enum(BikeType, _get_required(record, "bike_type")),
+        frame_material=_to_enum(FrameMaterial, _get_required(record, "frame_material")),
+        parking_time_during_last_month=int(float(_get_required(record, "parking_time_during_last_month"))),
+        user_risk_tendency=UserRiskTendency(*(float(_get_required(risk_tendency, i)) for i in RISK_TENDENCY_FIELDS)),
+        lock_price=float(record.get("lock_price", 0.0)),
+        wk_device_revision_number=int(record.get("wk_device_revision_number", 3)),
+        bike_is_electric=_to_bool(record.get("bike_is_electric", False)),
+        damage_insurance_included=_to_bool(record.get("damage_insurance_included", False))
+    )
+
+
+def _clean(value):
+    return None if isinstance(value, float) and isnan(value) else value
+
+
+def _score_location(
+        record: dict, power_of_distance: float, get_probability_function: bool,
+        max_dots: int | None = None, min_relative_weight: float | None = None
+) -> dict:
+    location = Location(_get_float(record, "latitude", "lat"), _get_float(record, "longitude", "lon"))
+    if location.latitude is None or location.longitude is None:
+        raise ValueError("Both latitude and longitude are required")
+    prediction, _ = estimate_theft_probability(
+        location, power_of_distance=power_of_distance, get_probability_function=get_probability_function,
+        max_dots=max_dots, min_relative_weight=min_relative_weight
+    )
+    result = {
+        "latitude": location.latitude,
+        "longitude": location.longitude,
+        "theft_probability": _clean(prediction.theft_probability),
+        "recovery_probability": _clean(prediction.recovery_probability),
+        "used_dots": prediction.used_dots
+    }
+    if prediction.truncation_bound is not None:
+        result["truncation_bound"] = prediction.truncation_bound
+    if get_probability_function:
+        params = prediction.regression_params
+        result["regression_params"] = {"a": float(params.a), "b": float(params.b)} if params else None
+        if record.get("parking_time") is not None:
+            probability = prediction.probability_function(int(float(record["parking_time"])))
+            result["theft_probability_at_parking_time"] = None if probability is None else float(probability)
+    return result
+
+
+def _score_locations(
+        records: list[dict], power_of_distance: float, get_probability_function: bool,
+        max_dots: int | None = None, min_relative_weight: float | None = None
+) -> tuple[list[dict], dict]:
+    """Runs in the worker processes. :return: the results and the metrics of the worker"""
+    results = []
+    for record in records:
+        try:
+            results.append(_score_location(
+                record, power_of_distance, get_probability_function, max_dots, min_relative_weight
+            ))
+        except (ValueError, TypeError, KeyError) as e:
+            results.append({"error": f"{type(e).__name__}: {e}"})
+    return results, metrics.pop_snapshot()
+
+
+def _init_worker(snapshot: str | None):
+    metrics.reset()  # the forked workers inherit the metrics of the parent
+    if snapshot:
+        load_snapshot(snapshot, check_sources=False)  # the parent has checked them
+
+
+def _score_insurance_data(records: list[dict]) -> list[dict]:
+    """
+    Runs in the model thread, the records that can't be parsed get an error instead of a premium,
+        as well as all the records of the chunk if the prediction fails
+    """
+    from services.insurance_premium_estimation_service import insurance_premium_prediction
+    results: list[dict] = []
+    parsed = []
+    for record in records:
+        try:
+            parsed.append(_parse_insurance_input_data(record))
+            results.append({})
+        except (ValueError, TypeError, KeyError) as e:
+            results.append({"error": f"{type(e).__name__}: {e}"})
+    try:
+        predictions = iter(insurance_premium_prediction(parsed) if parsed else [])
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        predictions = None
+    for result in results:
+        if not result:
+            if predictions is None:
+                result["error"] = error
+            else:
+                result["premium"] = next(predictions)
+    return results
+
+
+def _split_by_kind(
+        records: list[dict | _InvalidRecord]
+) -> tuple[dict[int, dict], list[int], list[dict], list[int], list[dict]]:
+    """:return: the errors of the invalid records by their indexes, then the locations and the insurance data"""
+    errors, location_indexes, locations, insurance_indexes, insurance_data = {}, [], [], [], []
+    for index, record in enumerate(records):
+        if isinstance(record, _InvalidRecord):
+            errors[index] = {"error": record.error}
+        elif not isinstance(record, dict):
+            errors[index] = {"error": f"TypeError: a record must be an object, not {type(record).__name__}"}
+        elif "bike_price" in record:
+            insurance_indexes.append(index)
+            insurance_data.append(record)
+        else:
+            location_indexes.append(index)
+            locations.append(record)
+    return errors, location_indexes, locations, insurance_indexes, insurance_data
+
+
+def _join_results(
+        size: int, errors: dict[int, dict],
+        locations: tuple[list[int], Future | None], insurance_data: tuple[list[int], Future | None]
+) -> list[dict]:
+    """The metrics of the worker that scored the locations are merged into the parent's ones"""
+    results: list[dict] = [errors.get(i, {}) for i in range(size)]
+    parts = []
+    location_indexes, location_future = locations
+    if location_future is not None:
+        location_results, worker_metrics = location_future.result()
+        metrics.merge(worker_metrics)
+        parts.append((location_indexes, location_results))
+    insurance_indexes, insurance_future = insurance_data
+    if insurance_future is not None:
+        parts.append((insurance_indexes, insurance_future.result()))
+    for indexes, part in parts:
+        for index, result in zip(indexes, part):
+            results[index] = result
+    return results
+
+
+def score(
+        records: Iterable[dict | _InvalidRecord], output: TextIO, power_of_distance: float = POWER_OF_DISTANCE,
+        get_probability_function: bool = False, chunk_size: int = DEFAULT_CHUNK_SIZE,
+        workers: int | None = None, progress: TextIO | None = sys.stderr, snapshot: str | None = None,
+        max_dots: int | None = None, min_relative_weight: float | None = None
+) -> int:
+    """
+    Score the records chunk by chunk. The location chunks are spread between the worker processes,
+        the insurance ones go to a single thread with the model. Not more than two chunks per worker are in flight,
+        so the memory usage doesn't depend on the size of the input.
+    :param snapshot: the path to a file created by the "snapshot" command
+    :param max_dots: see estimate_theft_probability, as well as min_relative_weight
+    :return: the number of scored records
+    """
+    workers = workers or cpu_count() or 1
+    if snapshot:
+        metadata = load_snapshot(snapshot)
+        if progress is not None:
+            print(
+                f"Loaded {metadata['aggregates']['locations']} locations from the snapshot "
+                f"in {metadata['loading_seconds'] * 1000:.1f} ms", file=progress, flush=True
+            )
+    records = iter(records)
+    pending: deque[tuple[int, dict[int, dict], tuple]] = deque()
+    count = 0
+    started = last_report = perf_counter()
+    # the forked workers inherit the snapshot loaded by the parent, the spawned ones have to load it themselves
+    with ProcessPoolExecutor(
+        workers, initializer=_init_worker, initargs=(snapshot if get_start_method() != "fork" else None, )
+    ) as executor, ThreadPoolExecutor(1) as model_executor:
+        # the workers have to be forked before the model thread is started
+        executor.submit(int).result()
+        while True:
+            chunk = [*islice(records, chunk_size)]
+            if chunk:
+                errors, location_indexes, locations, insurance_indexes, insurance_data = _split_by_kind(chunk)
+                pending.append((len(chunk), errors, (
+                    (location_indexes, executor.submit(
+                        _score_locations, locations, power_of_distance, get_probability_function,
+                        max_dots, min_relative_weight
+                    ) if locations else None),
+                    (insurance_indexes, model_executor.submit(
+                        _score_insurance_data, insurance_data
+                    ) if insurance_data else None)
+                )))
+            if not pending:
+                break
+            if chunk and len(pending) < workers * 2:
+                continue
+            size, errors, parts = pending.popleft()
+            for result in _join_results(size, errors, *parts):
+                output.write(json.dumps(result) + "\n")
+            count += size
+            if progress is not None and (perf_counter() - last_report >= PROGRESS_INTERVAL or not pending):
+                last_report = perf_counter()
+                elapsed = last_report - started
+                print(f"Scored {count} records, {count / elapsed:.1f} records/s", file=progress, flush=True)
+    output.flush()
+    return count
+
+
+def _parse_arguments():
+    parser = ArgumentParser(prog="python -m apis.cli")
+    commands = parser.add_subparsers(dest="command", required=True)
+    score_parser = commands.add_parser("score", help="score query locations and insurance data")
+    score_parser.add_argument("--input", help="JSONL or CSV file, stdin by default")
+    score_parser.add_argument("--output", help="JSONL file, stdout by default")
+    score_parser.add_argument("--format", choices=("jsonl", "csv"), help="guessed by the file extension by default")
+    score_parser.add_argument("--power-of-distance", type=float, default=POWER_OF_DISTANCE)
+    score_parser.add_argument(
+        "--regression", action="store_true",
+        help="calculate the regression parameters and the risk at the record's parking_time"
+    )
+    score_parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    score_parser.add_argument("--workers", type=int, help="the number of CPUs by default")
+    score_parser.add_argument("--snapshot", help="use the data and the model from this snapshot file")
+    score_parser.add_argument("--max-dots", type=int, help="use only this number of the closest dots")
+    score_parser.add_argument(
+        "--min-relative-weight", type=float,
+        help="stop taking the closest dots when the rest can't weigh more than this part of the taken ones"
+    )
+    snapshot_parser = commands.add_parser("snapshot", help="save the ready-to-query state into a file")
+    snapshot_parser.add_argument("path")
+    snapshot_parser.add_argument("--data", help="CSV file with the parking locations, the default one if omitted")
+    snapshot_parser.add_argument("--model", help="Keras model file, the default model if omitted")
+    train_parser = commands.add_parser("train", help="train the premium model with several configurations")
+    train_parser.add_argument("--configurations", help="JSON file with a list of configurations")
+    train_parser.add_argument(
+        "--dataset", help="NPZ file with the encoded dataset, generated and saved there if it doesn't exist"
+    )
+    train_parser.add_argument("--dataset-size", type=int, default=training.DEFAULT_DATASET_SIZE)
+    train_parser.add_argument("--seed", type=int)
+    train_parser.add_argument("--workers", type=int, help="as many as fit into the CPU cores by default")
+    train_parser.add_argument("--threads", type=int, default=1, help="TensorFlow threads per worker")
+    train_parser.add_argument("--epochs", type=int, default=training.DEFAULT_MAX_EPOCHS)
+    train_parser.add_argument("--patience", type=int, default=training.DEFAULT_PATIENCE)
+    train_parser.add_argument("--validation-split", type=float, default=training.DEFAULT_VALIDATION_SPLIT)
+    train_parser.add_argument("--model", required=True, help="where to save the best model")
+    train_parser.add_argument("--force", action="store_true", help="replace the model file if it exists")
+    train_parser.add_argument("--report", help="JSON file for the results, stdout by default")
+    archive_parser = commands.add_parser("archive", help="convert a CSV file with parking locations to an archive")
+    archive_parser.add_argument("input")
+    archive_parser.add_argument("output")
+    archive_parser.add_argument("--block-size", type=int, default=DEFAULT_BLOCK_SIZE)
+    extract_parser = commands.add_parser("extract", help="convert an archive back to a CSV file")
+    extract_parser.add_argument("input")
+    extract_parser.add_argument("output")
+    return parser.parse_args()
+
+
+def _train(options):
+    if exists(options.model) and not options.force:
+        sys.exit(f"{options.model} exists, pass --force to replace it with the best model of the sweep")
+    started = perf_counter()
+    x, y = training.load_or_generate_dataset(options.dataset, options.dataset_size, options.seed)
+    print(f"The dataset of {len(x)} records is ready in {perf_counter() - started:.1f} s", file=sys.stderr, flush=True)
+    if options.configurations:
+        with open(options.configurations, 'r') as file:
+            configurations = [training.TrainingConfiguration(**i) for i in json.load(file)]
+    else:
+        configurations = training.get_default_configurations(x.shape[1])
+
+    def report_progress(result: dict):
+        print(
+            f"Candidate {result['number']}: " + (
+                result["error"] if "error" in result else
+                f"val_loss {result['val_loss']:.4f} in {result['training_seconds']:.1f} s ({result['epochs']} epochs)"
+            ), file=sys.stderr, flush=True
+        )
+
+    results = training.run_training_sweep(
+        configurations, x, y, options.model, options.workers, options.threads, options.epochs,
+        options.patience, options.validation_split, options.seed, on_result=report_progress
+    )
+    if options.report:
+        with open(options.report, 'w') as file:
+            json.dump(results, file, indent=4)
+    else:
+        print(json.dumps(results, indent=4))
+
+
+def main():
+    options = _parse_arguments()
+    if options.command == "score":
+        input_format = options.format or ("csv" if (options.input or "").endswith(".csv") else "jsonl")
+        input_file = open(options.input, 'r', newline='') if options.input else sys.stdin
+        output_file = open(options.output, 'w') if options.output else sys.stdout
+        try:
+            score(
+                _read_records(input_file, input_format), output_file, options.power_of_distance,
+                options.regression, options.chunk_size, options.workers, snapshot=options.snapshot,
+                max_dots=options.max_dots, min_relative_weight=options.min_relative_weight
+            )
+        finally:
+            if options.input:
+                input_file.close()
+            if options.output:
+                output_file.close()
+    elif options.command == "snapshot":
+        print(json.dumps(create_snapshot(options.path, options.data, options.model), indent=4))
+    elif options.command == "train":
+        _train(options)
+    elif options.command == "archive":
+        add_user_id = has_user_id_column(options.input)
+        count = write_archive(
+            options.output, ParkingLocationsSource().from_csv(options.input, add_user_id=add_user_id),
+            add_user_id, options.block_size
+        )
+        print(f"Archived {count} locations", file=sys.stderr)
+    elif options.command == "extract":
+        add_user_id = ParkingLocationsArchive(options.input).has_user_id
+        count = write_csv(
+            options.output, ParkingLocationsSource().from_archive(options.input, add_user_id=add_user_id), add_user_id
+        )
+        print(f"Extracted {count} locations", file=sys.stderr)
+    if environ.get(metrics.METRICS_OUTPUT_ENV):
+        metrics.export_to_file(environ[metrics.METRICS_OUTPUT_ENV])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+from sys import platform
+from math import ceil
+from resource import getrusage, RUSAGE_SELF, RUSAGE_CHILDREN
+from typing import Final
+
+from utils import ReprMixin
+
+
+# ru_maxrss is in kilobytes everywhere except macOS, where it is in bytes
+_RSS_UNIT: Final = 1 if platform == "darwin" else 1024
+
+
+def percentile(values: list[float], q: float) -> float | None:
+    """Nearest-rank percentile, q is between 0 and 100"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, ceil(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def get_peak_rss() -> tuple[int, int]:
+    """
+    :return: peak RSS of this process and of the largest of its finished children, in bytes.
+    VmHWM is preferred over ru_maxrss where it exists, since ru_maxrss survives exec(),
+        so a spawned process would report the RSS of its parent as well
+    """
+    peak_rss = getrusage(RUSAGE_SELF).ru_maxrss * _RSS_UNIT
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    peak_rss = int(line.split()[1]) * 1024
+                    break
+    except OSError:
+        pass
+    return peak_rss, getrusage(RUSAGE_CHILDREN).ru_maxrss * _RSS_UNIT
+
+
+class BenchmarkResult(ReprMixin):
+    def __init__(
+            self, name: str, dataset_size: int, unit: str, items: int,
+            latencies: list[float], peak_rss: int, peak_children_rss: int
+    ):
+        """
+        :param name: the name of the benchmarked case
+        :param dataset_size: the number of events (or insurance records) the case was run on
+        :param unit: what the items are: rows, queries, events, records
+        :param items: the number of processed items during all the calls
+        :param latencies: duration of every call, in seconds
+        :param peak_rss: peak resident set size of the process that ran the case, in bytes
+        :param peak_children_rss: peak RSS of the largest subprocess (e.g. ProcessPoolExecutor worker), in bytes
+        """
+        self.name = name
+        self.dataset_size = dataset_size
+        self.unit = unit
+        self.items = items
+        self.latencies = latencies
+        self.peak_rss = peak_rss
+        self.peak_children_rss = peak_children_rss
+
+    def as_dict(self) -> dict:
+        total_time = sum(self.latencies)
+        return {
+            "name": self.name,
+            "dataset_size": self.dataset_size,
+            "unit": self.unit,
+            "calls": len(self.latencies),
+            "items": self.items,
+            "total_seconds": total_time,
+            "throughput": (self.items / total_time) if total_time > 0.0 else None,
+            "p50_seconds": percentile(self.latencies, 50),
+            "p99_seconds": percentile(self.latencies, 99),
+            "peak_rss_bytes": self.peak_rss,
+            "peak_children_rss_bytes": self.peak_children_rss
+        }
@@ -0,0 +1,105 @@
+"""
+Usage (from the project root, where the model file is):
+    python -m benchmarks --sizes 1000 10000 100000 --output bench.json
+Every case runs in a fresh process, the results are printed (or written) as JSON.
+"""
+import os
+import sys
+import json
+import platform
+import subprocess
+from argparse import ArgumentParser
+from multiprocessing import get_context
+from tempfile import gettempdir
+from typing import Final
+
+from benchmarks.cases import CASES, run_case
+from benchmarks.datasets import get_dataset_path
+from services.parking_locations_service import POWER_OF_DISTANCE
+
+
+RESULTS_FORMAT_VERSION: Final = 1
+DEFAULT_SIZES: Final = (10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7)
+
+
+def _get_git_revision() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _parse_arguments():
+    parser = ArgumentParser(prog="python -m benchmarks", description="Performance benchmarks on synthetic datasets")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="dataset sizes (events)")
+    parser.add_argument("--cases", nargs="+", choices=[*CASES], default=[*CASES])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3, help="how many times the batch cases are repeated")
+    parser.add_argument("--queries", type=int, default=20, help="number of query locations per size")
+    parser.add_argument("--batch-size", type=int, default=1000, help="insurance records per call")
+    parser.add_argument("--power-of-distance", type=float, default=POWER_OF_DISTANCE)
+    parser.add_argument(
+        "--pipeline-max-size", type=int, default=10 ** 4,
+        help="calculate_premium_and_accuracy is quadratic, bigger sizes are skipped"
+    )
+    parser.add_argument("--insurance-max-size", type=int, default=10 ** 6, help="bigger sizes are skipped")
+    parser.add_argument("--data-dir", default=os.path.join(gettempdir(), "bicycle-theft-benchmarks"))
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    return parser.parse_args()
+
+
+def _get_max_size(name: str, options) -> int | None:
+    if name == "calculate_premium_and_accuracy":
+        return options.pipeline_max_size
+    if not CASES[name][2]:
+        return options.insurance_max_size
+    return None
+
+
+def main():
+    options = _parse_arguments()
+    context = get_context("spawn")
+    results = []
+    for size in sorted(options.sizes):
+        path = None
+        for name in options.cases:
+            max_size = _get_max_size(name, options)
+            if max_size is not None and size > max_size:
+                continue
+            if CASES[name][2] and path is None:
+                print(f"Preparing the dataset of {size} events", file=sys.stderr)
+                path = get_dataset_path(options.data_dir, size, options.seed)
+            print(f"Running {name} on {size}", file=sys.stderr)
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=run_case, args=(name, path, size, options, sender))
+            process.start()
+            sender.close()
+            try:
+                result = receiver.recv()
+            except EOFError:
+                result = {"name": name, "dataset_size": size, "error": "the benchmark process crashed"}
+            process.join()
+            results.append(result)
+    report = {
+        "format_version": RESULTS_FORMAT_VERSION,
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "git_revision": _get_git_revision()
+        },
+        "parameters": {key: value for key, value in vars(options).items() if key not in ("output", "data_dir")},
+        "results": results
+    }
+    if options.output:
+        with open(options.output, 'w') as file:
+            json.dump(report, file, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+
+
+if __name__ == "__main__":
+    main()
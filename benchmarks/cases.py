@@ -0,0 +1,132 @@
+"""
+Every case returns the number of processed items and the duration of every call.
+The modules that load the Keras model are imported inside the cases, so the other cases can run without it.
+"""
+import os
+from argparse import Namespace
+from contextlib import redirect_stdout
+from time import perf_counter
+from typing import Callable, Final
+
+from benchmarks import BenchmarkResult, get_peak_rss
+from benchmarks.datasets import get_query_locations, get_insurance_data
+from repository import parking_locations_repository
+from repository.parking_locations_repository import ParkingLocationsSource, stream_parking_locations_nearby
+from services.parking_locations_service import estimate_theft_probability, get_max_distance
+
+
+def _use_dataset(path: str):
+    parking_locations_repository.DATA_SOURCE_FILE = path
+
+
+def _chunks(data: list, size: int):
+    for i in range(0, len(data), size):
+        yield data[i:i + size]
+
+
+def bench_from_csv(path: str, size: int, options: Namespace) -> tuple[int, list[float]]:
+    items, latencies = 0, []
+    for _ in range(options.repeat):
+        started = perf_counter()
+        items += sum(1 for _ in ParkingLocationsSource().from_csv(path, add_user_id=True))
+        latencies.append(perf_counter() - started)
+    return items, latencies
+
+
+def bench_stream_parking_locations_nearby(path: str, size: int, options: Namespace) -> tuple[int, list[float]]:
+    _use_dataset(path)
+    radius = get_max_distance(options.power_of_distance)
+    latencies = []
+    for location in get_query_locations(options.queries, options.seed):
+        started = perf_counter()
+        for _ in stream_parking_locations_nearby(location, radius):
+            pass
+        latencies.append(perf_counter() - started)
+    return len(latencies), latencies
+
+
+def _bench_estimation(path: str, options: Namespace, get_probability_function: bool) -> tuple[int, list[float]]:
+    _use_dataset(path)
+    if get_probability_function:
+        import statsmodels.api  # imported on the first fit otherwise
+    latencies = []
+    for location in get_query_locations(options.queries, options.seed):
+        started = perf_counter()
+        estimate_theft_probability(
+            location, power_of_distance=options.power_of_distance, get_probability_function=get_probability_function
+        )
+        latencies.append(perf_counter() - started)
+    return len(latencies), latencies
+
+
+def bench_estimate_theft_probability(path: str, size: int, options: Namespace) -> tuple[int, list[float]]:
+    return _bench_estimation(path, options, get_probability_function=False)
+
+
+def bench_estimate_theft_probability_with_regression(
+        path: str, size: int, options: Namespace
+) -> tuple[int, list[float]]:
+    return _bench_estimation(path, options, get_probability_function=True)
+
+
+def bench_calculate_premium_and_accuracy(path: str, size: int, options: Namespace) -> tuple[int, list[float]]:
+    import main
+    _use_dataset(path)
+    main.DATA_SOURCE_FILE = path
+    main.PREMIUM_CACHE_DIRECTORY = None  # otherwise the repeats would measure the cache hits
+    latencies = []
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        for _ in range(options.repeat):
+            started = perf_counter()
+            main.calculate_premium_and_accuracy()
+            latencies.append(perf_counter() - started)
+    return size * len(latencies), latencies
+
+
+def bench_prepare_insurance_data(path: str, size: int, options: Namespace) -> tuple[int, list[float]]:
+    from services.insurance_premium_estimation_service import prepare_insurance_data
+    data = [i.as_list_of_values() for i in get_insurance_data(size, options.seed)]
+    latencies = []
+    for _ in range(options.repeat):
+        for chunk in _chunks(data, options.batch_size):
+            started = perf_counter()
+            prepare_insurance_data(chunk)
+            latencies.append(perf_counter() - started)
+    return size * options.repeat, latencies
+
+
+def bench_insurance_premium_prediction(path: str, size: int, options: Namespace) -> tuple[int, list[float]]:
+    from services.insurance_premium_estimation_service import insurance_premium_prediction, get_model
+    data = get_insurance_data(size, options.seed)
+    get_model()  # the model is loaded on the first prediction otherwise
+    latencies = []
+    for _ in range(options.repeat):
+        for chunk in _chunks(data, options.batch_size):
+            started = perf_counter()
+            insurance_premium_prediction(chunk)
+            latencies.append(perf_counter() - started)
+    return size * options.repeat, latencies
+
+
+# name: (function, unit, uses the events dataset)
+CASES: Final[dict[str, tuple[Callable[[str, int, Namespace], tuple[int, list[float]]], str, bool]]] = {
+    "from_csv": (bench_from_csv, "rows", True),
+    "stream_parking_locations_nearby": (bench_stream_parking_locations_nearby, "queries", True),
+    "estimate_theft_probability": (bench_estimate_theft_probability, "queries", True),
+    "estimate_theft_probability_with_regression": (bench_estimate_theft_probability_with_regression, "queries", True),
+    "calculate_premium_and_accuracy": (bench_calculate_premium_and_accuracy, "events", True),
+    "prepare_insurance_data": (bench_prepare_insurance_data, "records", False),
+    "insurance_premium_prediction": (bench_insurance_premium_prediction, "records", False),
+}
+
+
+def run_case(name: str, path: str | None, size: int, options: Namespace, connection) -> None:
+    """Meant to be run in a separate process, so that the peak RSS belongs to this case only"""
+    function, unit, _ = CASES[name]
+    try:
+        items, latencies = function(path, size, options)
+        result = BenchmarkResult(name, size, unit, items, latencies, *get_peak_rss()).as_dict()
+    except Exception as e:
+        result = {"name": name, "dataset_size": size, "error": f"{type(e).__name__}: {e}"}
+    connection.send(result)
+    connection.close()
@@ -0,0 +1,52 @@
+import os
+import random
+from typing import Final
+
+from repository import Location
+from repository.parking_locations_repository import ParkingLocationsSource, write_csv
+from repository.insurance_premium_estimation_repository import (generate_random_insurance_data, InsuranceInputData,
+                                                                seed_random_generators)
+
+
+# the area covered by the data_with_8users.csv, so that the density of the dots grows with the dataset size
+DEFAULT_AREA: Final = (47.52, 50.58, 32.84, 37.04)  # lat_min, lat_max, lon_min, lon_max
+DEFAULT_NUM_OF_USERS: Final = 8
+
+
+def _seed(seed: int, size: int, purpose: str):
+    seed_random_generators(f"{seed}-{size}-{purpose}")
+
+
+def get_dataset_path(
+        data_dir: str, size: int, seed: int, num_of_users: int = DEFAULT_NUM_OF_USERS,
+        area: tuple[float, float, float, float] = DEFAULT_AREA
+) -> str:
+    """
+    Generate a reproducible CSV file with the given number of events (with the user column),
+        or reuse it if it was generated before
+    """
+    path = os.path.join(data_dir, f"events-{size}-users-{num_of_users}-seed-{seed}.csv")
+    if os.path.exists(path):
+        return path
+    os.makedirs(data_dir, exist_ok=True)
+    _seed(seed, size, "events")
+    temp_path = path + ".tmp"
+    write_csv(temp_path, ParkingLocationsSource(*area).random_with_user_id(size, num_of_users), add_user_id=True)
+    os.replace(temp_path, path)
+    return path
+
+
+def get_query_locations(
+        number: int, seed: int, area: tuple[float, float, float, float] = DEFAULT_AREA
+) -> list[Location]:
+    _seed(seed, number, "queries")
+    lat_min, lat_max, lon_min, lon_max = area
+    return [
+        Location(round(random.uniform(lat_min, lat_max), 7), round(random.uniform(lon_min, lon_max), 7))
+        for _ in range(number)
+    ]
+
+
+def get_insurance_data(number: int, seed: int) -> list[InsuranceInputData]:
+    _seed(seed, number, "insurance")
+    return [generate_random_insurance_data() for _ in range(number)]
@@ -1,20 +1,26 @@
 from matplotlib import pyplot as plt
 from sys import maxsize
 import json
+from os import environ
 from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
 from typing import Final
 
+from utils import metrics, get_file_hash
 from utils.parking_locations_drawer import draw_dots, draw_prediction_function
+from repository import parking_locations_repository
 from repository.parking_locations_repository import Location, ParkingLocationsSource, ParkingLocation, DATA_SOURCE_FILE
-from services.insurance_premium_estimation_service import get_user_risk_tendency, insurance_premium_prediction
+from services.insurance_premium_estimation_service import (get_user_risk_tendency, insurance_premium_prediction,
+                                                           MODEL_FILE)
 from repository.insurance_premium_estimation_repository import (UserRiskTendency, InsuranceInputData, BikeType,
                                                                 LockType, FrameMaterial)
 from services.parking_locations_service import (estimate_theft_probability, get_prediction_accuracy,
-                                                TheftProbabilityPrediction, PredictionAccuracy)
+                                                TheftProbabilityPrediction, PredictionAccuracy, get_max_distance,
+                                                POWER_OF_DISTANCE)
+from repository.premium_cache_repository import (PremiumCache, get_users_input_hashes, make_key,
+                                                 DEFAULT_MAX_CACHE_SIZE)
 
 
-# POWER_OF_DISTANCE: Final = 1.432
-POWER_OF_DISTANCE: Final = 1.5
 INSURANCE_DATA_PLACEHOLDER: Final = InsuranceInputData(
     bike_price=600,
     bike_type=BikeType.mtb,
@@ -27,6 +33,11 @@ INSURANCE_DATA_PLACEHOLDER: Final = InsuranceInputData(
     parking_time_during_last_month=144000,
     wk_device_revision_number=3
 )
+# the per-user results are cached on disk only if this is set
+PREMIUM_CACHE_DIRECTORY: Final = environ.get("PREMIUM_CACHE_DIRECTORY")
+PREMIUM_CACHE_MAX_SIZE: Final = int(environ.get("PREMIUM_CACHE_MAX_SIZE", DEFAULT_MAX_CACHE_SIZE))
+# has to be increased whenever the scoring code changes the results, so that the cached ones are not reused
+CACHE_VERSION: Final = 1
 
 
 def predict_theft(location: Location, power_of_distance: float = None):
@@ -44,26 +55,43 @@ def predict_theft(location: Location, power_of_distance: float = None):
     plt.show()
 
 
+def _init_worker(data_source_file: str):
+    """The spawned workers import the repository again, with the default DATA_SOURCE_FILE"""
+    metrics.reset()  # the forked workers inherit the metrics of the parent
+    parking_locations_repository.DATA_SOURCE_FILE = data_source_file
+
+
 def _add_info(u_id, loc, num):
-    return u_id, loc, estimate_theft_probability(
+    started = perf_counter()
+    estimation = estimate_theft_probability(
         loc, get_probability_function=True, count_limit=num, power_of_distance=POWER_OF_DISTANCE
     )[0]
+    metrics.observe("worker_task_seconds", perf_counter() - started)
+    return u_id, loc, estimation, metrics.pop_snapshot()
 
 
-def calculate_risk_tendency_and_accuracy() -> dict[int: tuple[UserRiskTendency, PredictionAccuracy]]:
+def calculate_risk_tendency_and_accuracy(
+        only_users: set[int] | None = None
+) -> dict[int: tuple[UserRiskTendency, PredictionAccuracy]]:
+    """If only_users is passed, the events of the other users are skipped"""
     users: dict[int: list[tuple[ParkingLocation, TheftProbabilityPrediction]]] = {}
     locations_generator = ParkingLocationsSource().from_csv(DATA_SOURCE_FILE, add_user_id=True)
-    executor = ProcessPoolExecutor()
     futures = []
-    for number, location_with_user in zip(range(maxsize), locations_generator):
-        location, user_id = location_with_user
-        if not users.get(user_id):
-            users[user_id] = []
-        futures.append(executor.submit(_add_info, user_id, location, number))
-    for i in futures:
-        uid, location, estimation = i.result()
-        users[uid].append((location, estimation))
-    executor.shutdown()
+    started = perf_counter()
+    with ProcessPoolExecutor(initializer=_init_worker, initargs=(DATA_SOURCE_FILE, )) as executor:
+        for number, location_with_user in zip(range(maxsize), locations_generator):
+            location, user_id = location_with_user
+            if only_users is not None and user_id not in only_users:
+                continue
+            if not users.get(user_id):
+                users[user_id] = []
+            futures.append(executor.submit(_add_info, user_id, location, number))
+        for i in futures:
+            uid, location, estimation, worker_metrics = i.result()
+            users[uid].append((location, estimation))
+            metrics.merge(worker_metrics)
+    metrics.observe("process_pool_seconds", perf_counter() - started)
+    metrics.count("process_pool_tasks", len(futures))
     return {user_id: (
         get_user_risk_tendency(users[user_id]), get_prediction_accuracy(users[user_id])
     ) for user_id in users}
@@ -78,13 +106,51 @@ def theft_prediction_example():
     # predict_theft(Location(48.50305, 35.05875))  # right next to a red dot
 
 
-def calculate_premium_and_accuracy():
-    result = calculate_risk_tendency_and_accuracy()
+def _calculate_premium_and_accuracy(
+        only_users: set[int] | None = None
+) -> dict[int: tuple[UserRiskTendency, PredictionAccuracy, float]]:
+    result = calculate_risk_tendency_and_accuracy(only_users)
     users = [*sorted(result)]
     insurance_data: list[InsuranceInputData] = [INSURANCE_DATA_PLACEHOLDER.__copy__() for _ in users]
     for user_id, insurance_data_item in zip(users, insurance_data):
         insurance_data_item.user_risk_tendency = result[user_id][0].__copy__()
-    predictions = insurance_premium_prediction(insurance_data)
+    predictions = insurance_premium_prediction(insurance_data) if users else []
+    return {user_id: (*result[user_id], prediction) for user_id, prediction in zip(users, predictions)}
+
+
+def _calculate_premium_and_accuracy_with_cache() -> dict[int: tuple[UserRiskTendency, PredictionAccuracy, float]]:
+    """Only the users whose events, the data around them or the model have changed since the last run are rescored"""
+    cache = PremiumCache(PREMIUM_CACHE_DIRECTORY, PREMIUM_CACHE_MAX_SIZE)
+    common_key_part = (
+        CACHE_VERSION, POWER_OF_DISTANCE, get_file_hash(MODEL_FILE), INSURANCE_DATA_PLACEHOLDER.as_list_of_values()
+    )
+    input_hashes = get_users_input_hashes(DATA_SOURCE_FILE, get_max_distance(POWER_OF_DISTANCE))
+    keys = {user_id: make_key(input_hash, *common_key_part) for user_id, input_hash in input_hashes.items()}
+    result = {}
+    for user_id, key in keys.items():
+        cached = cache.get(key)
+        if cached is not None:
+            result[user_id] = (
+                UserRiskTendency(**cached["risk_tendency"]), PredictionAccuracy(**cached["accuracy"]), cached["premium"]
+            )
+    metrics.count("premium_cache_hits", len(result))
+    metrics.count("premium_cache_misses", len(keys) - len(result))
+    calculated = _calculate_premium_and_accuracy(set(keys) - set(result)) if len(result) < len(keys) else {}
+    for user_id, (risk_tendency, accuracy, premium) in calculated.items():
+        cache.put(keys[user_id], {
+            "risk_tendency": risk_tendency.__dict__, "accuracy": accuracy.__dict__, "premium": premium
+        })
+    cache.evict()
+    return result | calculated
+
+
+def calculate_premium_and_accuracy():
+    if PREMIUM_CACHE_DIRECTORY:
+        result = _calculate_premium_and_accuracy_with_cache()
+    else:
+        result = _calculate_premium_and_accuracy()
+    users = [*sorted(result)]
+    predictions = {i: result[i][2] for i in users}
     print("Risk tendency:")
     print(json.dumps({i: str(result[i][0]) for i in users}, indent=4))
     print("Premium estimations:")
@@ -96,3 +162,5 @@ def calculate_premium_and_accuracy():
 if __name__ == "__main__":
     # theft_prediction_example()
     calculate_premium_and_accuracy()
+    if environ.get(metrics.METRICS_OUTPUT_ENV):
+        metrics.export_to_file(environ[metrics.METRICS_OUTPUT_ENV])
@@ -1,9 +1,10 @@
 from typing import Final
 from enum import Enum
-from random import uniform, choice
+from random import uniform, choice, seed as seed_random
 from math import log10, fabs, inf
+from zlib import crc32
 
-from numpy.random import normal
+from numpy.random import normal, seed as seed_numpy_random
 
 from utils import ReprMixin
 
@@ -124,6 +125,12 @@ def _bounds(value, minimum=0.0, maximum=1.0):
     return max(minimum, min(value, maximum))
 
 
+def seed_random_generators(seed: int | str):
+    """Both the random module and numpy.random are used by the generators, a string seed is hashed for NumPy"""
+    seed_random(seed)
+    seed_numpy_random(crc32(seed.encode()) if isinstance(seed, str) else seed)
+
+
 def generate_random_insurance_data() -> InsuranceInputData:
     price = round(choice((
         min(STD_PRICE + fabs(normal(scale=(MAX_PRICE - STD_PRICE) / 2)), MAX_PRICE),
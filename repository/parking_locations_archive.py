@@ -0,0 +1,273 @@
+"""
+A compact binary format for the parking locations, for storing and transferring long histories.
+The locations are sorted by the cells of a lat/lon grid (BLOCK_CELL_SIZE) and split into blocks,
+    every block is compressed separately and its bounding box is kept in the header,
+    so a query only decompresses the blocks intersecting its box.
+Layout: magic, header length (8 bytes, little-endian), JSON header, compressed blocks.
+Columns of a block (before the compression):
+    latitude and longitude - int32 fixed point (COORDINATE_SCALE units per degree), delta-encoded;
+    flags - 2 bits per location (FLAG_CODES);
+    parking time, the number of the source row (delta-encoded) and the user id - zigzag LEB128 varints.
+"""
+import os
+import json
+import zlib
+from typing import Final, Generator, Iterable
+
+import numpy as np
+
+from . import ParkingLocation
+from .parking_locations_index import _get_cell_keys, NO_USER
+from utils import metrics
+
+
+MAGIC: Final = b"BTARCH01"
+FORMAT_VERSION: Final = 1
+# the source data has 7 decimal places, so the coordinates are stored losslessly, and 180 * 10^7 still fits into int32
+COORDINATE_SCALE: Final = 10 ** 7
+DEFAULT_BLOCK_SIZE: Final = 4096
+# coarser than the cells of the ParkingLocationsIndex, so that the blocks of the dense areas are close to squares
+BLOCK_CELL_SIZE: Final = 0.1  # degrees
+COMPRESSION_LEVEL: Final = 6
+COLUMNS: Final = ("latitude", "longitude", "flags", "parking_time", "row", "user_id")
+# (stolen, recovered) -> 2-bit code
+FLAG_CODES: Final = {(False, None): 0, (True, None): 1, (True, False): 2, (True, True): 3}
+_FLAG_VALUES: Final = {code: flags for flags, code in FLAG_CODES.items()}
+_MAX_VARINT_SIZE: Final = 10
+# write_archive() keeps the locations in NumPy arrays, only this number of them is kept as Python objects at a time
+_CHUNK_SIZE: Final = 65536
+
+
+def _encode_varints(values: np.ndarray) -> bytes:
+    """Zigzag LEB128: 7 bits per byte, the highest bit is set in every byte but the last one of a value"""
+    values = np.asarray(values, dtype=np.int64)
+    zigzag = ((values << 1) ^ (values >> 63)).astype(np.uint64)
+    sizes = np.ones(len(zigzag), dtype=np.int64)
+    for i in range(1, _MAX_VARINT_SIZE):
+        sizes += zigzag >= np.uint64(1 << (7 * i))
+    positions = np.arange(sizes.max() if len(sizes) else 0)
+    groups = (zigzag[:, np.newaxis] >> (positions * 7).astype(np.uint64)) & np.uint64(0x7f)
+    groups |= (positions < sizes[:, np.newaxis] - 1).astype(np.uint64) << np.uint64(7)
+    return groups[positions < sizes[:, np.newaxis]].astype(np.uint8).tobytes()
+
+
+def _decode_varints(data: bytes, count: int) -> np.ndarray:
+    encoded = np.frombuffer(data, dtype=np.uint8)
+    ends = np.flatnonzero(encoded < 0x80)
+    if len(ends) != count:
+        raise ValueError(f"Expected {count} values, found {len(ends)}")
+    if not count:
+        return np.empty(0, dtype=np.int64)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    positions = np.arange(len(encoded)) - np.repeat(starts, ends - starts + 1)
+    parts = (encoded & 0x7f).astype(np.uint64) << (positions * 7).astype(np.uint64)
+    zigzag = np.add.reduceat(parts, starts)
+    return (zigzag >> np.uint64(1)).astype(np.int64) ^ -(zigzag & np.uint64(1)).astype(np.int64)
+
+
+def _encode_deltas(values: np.ndarray) -> bytes:
+    """
+    The differences are wrapped into int32 (the longitude may jump by more than 2^31),
+        the cumulative sum wraps back the same way
+    """
+    return np.diff(values.astype(np.int64), prepend=0).astype('<i4').tobytes()
+
+
+def _decode_deltas(data: bytes) -> np.ndarray:
+    return np.cumsum(np.frombuffer(data, dtype='<i4'), dtype=np.int32)
+
+
+def _pack_flags(codes: np.ndarray) -> bytes:
+    codes = np.concatenate((codes.astype(np.uint8), np.zeros(-len(codes) % 4, dtype=np.uint8)))
+    return (codes[0::4] | (codes[1::4] << 2) | (codes[2::4] << 4) | (codes[3::4] << 6)).astype(np.uint8).tobytes()
+
+
+def _unpack_flags(data: bytes, count: int) -> np.ndarray:
+    packed = np.frombuffer(data, dtype=np.uint8)
+    return np.stack([(packed >> shift) & 3 for shift in (0, 2, 4, 6)], axis=1).reshape(-1)[:count]
+
+
+def _encode_block(columns: dict[str, np.ndarray]) -> tuple[bytes, list[int]]:
+    """:return: the compressed block and the sizes of the columns before the compression"""
+    sections = [
+        _encode_deltas(columns["latitude"]), _encode_deltas(columns["longitude"]), _pack_flags(columns["flags"]),
+        _encode_varints(columns["parking_time"]), _encode_varints(np.diff(columns["row"], prepend=0)),
+        _encode_varints(columns["user_id"]) if "user_id" in columns else b''
+    ]
+    return zlib.compress(b''.join(sections), COMPRESSION_LEVEL), [len(i) for i in sections]
+
+
+def _decode_block(data: bytes, sizes: list[int], count: int) -> dict[str, np.ndarray]:
+    data = zlib.decompress(data)
+    sections = {}
+    offset = 0
+    for name, size in zip(COLUMNS, sizes):
+        sections[name] = data[offset:offset + size]
+        offset += size
+    columns = {
+        "latitude": _decode_deltas(sections["latitude"]),
+        "longitude": _decode_deltas(sections["longitude"]),
+        "flags": _unpack_flags(sections["flags"], count),
+        "parking_time": _decode_varints(sections["parking_time"], count),
+        "row": np.cumsum(_decode_varints(sections["row"], count)),
+    }
+    if sections["user_id"]:
+        columns["user_id"] = _decode_varints(sections["user_id"], count)
+    return columns
+
+
+def _to_arrays(chunk: list[tuple[float, float, int, int, int]]) -> dict[str, np.ndarray]:
+    latitude, longitude, parking_time, flags, user_id = zip(*chunk) if chunk else ((), (), (), (), ())
+    return {
+        "latitude": np.round(np.array(latitude, dtype=np.float64) * COORDINATE_SCALE).astype(np.int32),
+        "longitude": np.round(np.array(longitude, dtype=np.float64) * COORDINATE_SCALE).astype(np.int32),
+        "parking_time": np.array(parking_time, dtype=np.int64),
+        "flags": np.array(flags, dtype=np.uint8),
+        "user_id": np.array(user_id, dtype=np.int64)
+    }
+
+
+def write_archive(
+        path_to_file: str, locations: Iterable[ParkingLocation | tuple[ParkingLocation, int]],
+        add_user_id: bool = False, block_size: int = DEFAULT_BLOCK_SIZE
+) -> int:
+    """
+    The same as write_csv(), but in the archive format.
+    The coordinates are rounded to 1 / COORDINATE_SCALE of a degree.
+    :return: the number of written locations
+    """
+    chunks = []
+    chunk = []
+    for item in locations:
+        location, user = item if add_user_id else (item, NO_USER)
+        chunk.append((
+            location.latitude, location.longitude, location.parking_time,
+            FLAG_CODES[location.stolen, location.recovered], user
+        ))
+        if len(chunk) >= _CHUNK_SIZE:
+            chunks.append(_to_arrays(chunk))
+            chunk = []
+    chunks.append(_to_arrays(chunk))
+    columns = {name: np.concatenate([i[name] for i in chunks]) for name in chunks[0]}
+    del chunks
+    if not add_user_id:
+        del columns["user_id"]
+    order = np.lexsort((
+        columns["longitude"], columns["latitude"],
+        _get_cell_keys(
+            columns["latitude"] / COORDINATE_SCALE, columns["longitude"] / COORDINATE_SCALE, BLOCK_CELL_SIZE
+        )
+    ))
+    blocks, compressed = [], []
+    for start in range(0, len(order), block_size):
+        rows = order[start:start + block_size]
+        block = {"row": rows.astype(np.int64), **{name: column[rows] for name, column in columns.items()}}
+        data, sizes = _encode_block(block)
+        compressed.append(data)
+        blocks.append({
+            "count": len(block["row"]),
+            "size": len(data),
+            "sections": sizes,
+            "bbox": [int(block["latitude"].min()), int(block["latitude"].max()),
+                     int(block["longitude"].min()), int(block["longitude"].max())],
+            "first_row": int(block["row"].min())
+        })
+    offset = 0
+    for block in blocks:
+        block["offset"] = offset
+        offset += block["size"]
+    header = json.dumps({
+        "format_version": FORMAT_VERSION, "count": len(order), "has_user_id": add_user_id,
+        "coordinate_scale": COORDINATE_SCALE, "blocks": blocks
+    }).encode()
+    temp_path = f"{path_to_file}.{os.getpid()}.tmp"
+    with open(temp_path, 'wb') as file:
+        file.write(MAGIC + len(header).to_bytes(8, "little") + header)
+        for data in compressed:
+            file.write(data)
+    os.replace(temp_path, path_to_file)
+    return len(order)
+
+
+def _intersects(block_min: float, block_max: float, query_min: float, query_max: float) -> bool:
+    """Same rules as the filter of ParkingLocationsIndex.query(): query_min > query_max crosses the 180th meridian"""
+    if query_min > query_max:
+        return block_max >= query_min or block_min <= query_max
+    if query_max > query_min:
+        return block_max >= query_min and block_min <= query_max
+    return True
+
+
+class ParkingLocationsArchive:
+    def __init__(self, path_to_file: str):
+        """Only the header is read here"""
+        self.path = path_to_file
+        with open(path_to_file, 'rb') as file:
+            if file.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path_to_file} is not a parking locations archive")
+            header_size = int.from_bytes(file.read(8), "little")
+            header = json.loads(file.read(header_size))
+        if header["format_version"] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported archive format version: {header['format_version']}")
+        self.data_offset = len(MAGIC) + 8 + header_size
+        self.count: int = header["count"]
+        self.has_user_id: bool = header["has_user_id"]
+        self.scale: int = header["coordinate_scale"]
+        self.blocks: list[dict] = header["blocks"]
+
+    def __len__(self):
+        return self.count
+
+    def query(
+            self, lat_min: float = -90.0, lat_max: float = 90.0, lon_min: float = -180.0, lon_max: float = 180.0,
+            user_id: int | None = None, add_user_id: bool = False, count_limit: int | None = None
+    ) -> Generator[ParkingLocation | tuple[ParkingLocation, int], None, None]:
+        """
+        The locations inside the box in the order of the source rows, like ParkingLocationsIndex.query(),
+            including the filtering of the boxes crossing the 180th meridian
+        """
+        selected = [
+            block for block in self.blocks
+            if (count_limit is None or block["first_row"] < count_limit)
+            and _intersects(block["bbox"][0] / self.scale, block["bbox"][1] / self.scale, lat_min, lat_max)
+            and _intersects(block["bbox"][2] / self.scale, block["bbox"][3] / self.scale, lon_min, lon_max)
+        ]
+        parts = []
+        scanned_count = 0
+        with open(self.path, 'rb') as file:
+            for block in selected:
+                file.seek(self.data_offset + block["offset"])
+                columns = _decode_block(file.read(block["size"]), block["sections"], block["count"])
+                scanned_count += block["count"]
+                mask = np.ones(block["count"], dtype=bool)
+                if count_limit is not None:
+                    mask &= columns["row"] < count_limit
+                if user_id is not None and "user_id" in columns:
+                    mask &= (columns["user_id"] == user_id) | (columns["user_id"] == NO_USER)
+                latitude, longitude = columns["latitude"] / self.scale, columns["longitude"] / self.scale
+                for coord, coord_min, coord_max in ((latitude, lat_min, lat_max), (longitude, lon_min, lon_max)):
+                    if coord_min > coord_max:
+                        mask &= (coord >= coord_min) | (coord <= coord_max)
+                    elif coord_max > coord_min:
+                        mask &= (coord >= coord_min) & (coord <= coord_max)
+                parts.append((
+                    columns["row"][mask], latitude[mask], longitude[mask], columns["parking_time"][mask],
+                    columns["flags"][mask], columns["user_id"][mask] if "user_id" in columns else None
+                ))
+        metrics.count("archive_blocks_read", len(selected))
+        metrics.count("rows_scanned", scanned_count)
+        if not parts:
+            metrics.count("rows_passed_bbox_filter", 0)
+            return
+        row, latitude, longitude, parking_time, flags = (np.concatenate([i[n] for i in parts]) for n in range(5))
+        order = np.argsort(row, kind="stable")
+        metrics.count("rows_passed_bbox_filter", len(order))
+        add_user_id = add_user_id and self.has_user_id
+        users = np.concatenate([i[5] for i in parts])[order].tolist() if add_user_id else None
+        for number, (latitude, longitude, parking_time, flags) in enumerate(zip(
+                latitude[order].tolist(), longitude[order].tolist(),
+                parking_time[order].tolist(), flags[order].tolist()
+        )):
+            stolen, recovered = _FLAG_VALUES[flags]
+            item = ParkingLocation(latitude, longitude, parking_time, stolen=stolen, recovered=recovered)
+            yield (item, users[number]) if add_user_id else item
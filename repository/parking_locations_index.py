@@ -0,0 +1,349 @@
+import csv
+from math import floor, radians, degrees, sin, cos, asin, inf
+from typing import Final, Generator, Iterable
+
+import numpy as np
+
+from . import ParkingLocation
+from utils import metrics
+
+
+# about 550 meters, small enough for the nearest locations to be found in a few cells even in the densest areas
+CELL_SIZE: Final = 0.005  # degrees
+_LON_CELLS: Final = floor(360 / CELL_SIZE) + 2
+# flags
+STOLEN: Final = 1
+RECOVERY_KNOWN: Final = 2
+RECOVERED: Final = 4
+NO_USER: Final = -1
+_LAT_CELLS: Final = floor(180 / CELL_SIZE) + 1  # the last one is for the latitude of 90 exactly
+_WRAPPED_LON_CELLS: Final = round(360 / CELL_SIZE)  # the cell of the longitude of 180 is the same as of -180
+EARTH_RADIUS: Final = 6371008.8  # meters, the mean one, used for the haversine distances
+# the haversine distance differs from the geodesic one (geopy) by less than 0.6%
+HAVERSINE_ERROR: Final = 0.01
+
+
+def _get_cell_keys(latitude: np.ndarray, longitude: np.ndarray, cell_size: float = CELL_SIZE) -> np.ndarray:
+    lat_cells = np.floor((latitude + 90.0) / cell_size).astype(np.int64)
+    lon_cells = np.floor((longitude + 180.0) / cell_size).astype(np.int64)
+    return lat_cells * (floor(360 / cell_size) + 2) + lon_cells
+
+
+class ParkingLocationsIndex:
+    """
+    All the parking locations in memory, as NumPy arrays sorted by the cells of a regular lat/lon grid,
+        so that a bounding box query only touches the cells it intersects.
+    The arrays may be read-only views of a snapshot file (see services.snapshot_service).
+    """
+    ARRAY_NAMES: Final = ("latitude", "longitude", "parking_time", "flags", "user_id", "row", "cells", "cell_starts")
+
+    def __init__(
+            self, latitude: np.ndarray, longitude: np.ndarray, parking_time: np.ndarray, flags: np.ndarray,
+            user_id: np.ndarray, row: np.ndarray, cells: np.ndarray, cell_starts: np.ndarray
+    ):
+        """
+        The locations are ordered by their grid cells.
+        :param row: the number of the row in the source file, used for the count_limit and for the ordering
+        :param cells: sorted keys of the non-empty grid cells
+        :param cell_starts: the index of the first location of every cell, plus the number of locations at the end
+        """
+        self.latitude = latitude
+        self.longitude = longitude
+        self.parking_time = parking_time
+        self.flags = flags
+        self.user_id = user_id
+        self.row = row
+        self.cells = cells
+        self.cell_starts = cell_starts
+
+    def __len__(self):
+        return len(self.row)
+
+    @classmethod
+    def from_arrays(
+            cls, latitude: np.ndarray, longitude: np.ndarray, parking_time: np.ndarray,
+            flags: np.ndarray, user_id: np.ndarray
+    ) -> 'ParkingLocationsIndex':
+        """The arrays are in the order of the rows of the source"""
+        cell_keys = _get_cell_keys(latitude, longitude)
+        order = np.argsort(cell_keys, kind="stable")
+        cells, cell_starts = np.unique(cell_keys[order], return_index=True)
+        return cls(
+            latitude[order], longitude[order], parking_time[order], flags[order], user_id[order],
+            order.astype(np.int64), cells, np.append(cell_starts, len(order)).astype(np.int64)
+        )
+
+    @classmethod
+    def from_csv(cls, path_to_file: str) -> 'ParkingLocationsIndex':
+        latitude, longitude, parking_time, flags, user_id = [], [], [], [], []
+        with open(path_to_file, 'r') as file:
+            reader = csv.reader(file)
+            for _ in reader:
+                break
+            for line in reader:
+                latitude.append(float(line[0]))
+                longitude.append(float(line[1]))
+                parking_time.append(int(line[2]))
+                stolen = line[3].lower() == "true"
+                flags.append(
+                    (STOLEN if stolen else 0) |
+                    ((RECOVERY_KNOWN | (RECOVERED if line[4].lower() == "true" else 0)) if line[4] else 0)
+                )
+                user_id.append(int(line[5]) if len(line) > 5 else NO_USER)
+        return cls.from_arrays(
+            np.array(latitude, dtype=np.float64), np.array(longitude, dtype=np.float64),
+            np.array(parking_time, dtype=np.int64), np.array(flags, dtype=np.uint8), np.array(user_id, dtype=np.int64)
+        )
+
+    def arrays(self) -> dict[str, np.ndarray]:
+        return {name: getattr(self, name) for name in self.ARRAY_NAMES}
+
+    def _get_candidates(self, lat_min: float, lat_max: float, lon_min: float, lon_max: float) -> np.ndarray:
+        """Indexes of the locations in the grid cells intersecting the bounding box"""
+        if lat_min > lat_max:  # handled like the longitude, just in case
+            lat_ranges = ((-90.0, lat_max), (lat_min, 90.0))
+        else:
+            lat_ranges = ((lat_min, lat_max), )
+        if lon_min > lon_max:
+            lon_ranges = ((-180.0, lon_max), (lon_min, 180.0))
+        else:
+            lon_ranges = ((lon_min, lon_max), )
+        slices = []
+        for first_lat, last_lat in lat_ranges:
+            first_lat_cell, last_lat_cell = (floor((i + 90.0) / CELL_SIZE) for i in (first_lat, last_lat))
+            for first_lon, last_lon in lon_ranges:
+                first_lon_cell, last_lon_cell = (floor((i + 180.0) / CELL_SIZE) for i in (first_lon, last_lon))
+                lat_cells = np.arange(first_lat_cell, last_lat_cell + 1, dtype=np.int64) * _LON_CELLS
+                first_cells = np.searchsorted(self.cells, lat_cells + first_lon_cell, side="left")
+                last_cells = np.searchsorted(self.cells, lat_cells + last_lon_cell, side="right")
+                slices += [
+                    np.arange(self.cell_starts[first], self.cell_starts[last])
+                    for first, last in zip(first_cells, last_cells) if last > first
+                ]
+        return np.concatenate(slices) if slices else np.empty(0, dtype=np.int64)
+
+    def _get_ranges(self, lat_cells: Iterable[int], lon_cells: list[tuple[int, int]]) -> list[tuple[int, int]]:
+        """
+        :param lon_cells: (first, last) ranges of the longitude cells, may be outside [0, _WRAPPED_LON_CELLS)
+        :return: (start, end) ranges of the indexes of the locations in these cells of the given latitude rows
+        """
+        lat_cells = [i for i in lat_cells if 0 <= i < _LAT_CELLS]
+        if not lat_cells:
+            return []
+        ranges = []
+        for first, last in lon_cells:
+            if last - first + 1 >= _WRAPPED_LON_CELLS:
+                ranges.append((0, _WRAPPED_LON_CELLS - 1))
+                continue
+            width = last - first
+            first %= _WRAPPED_LON_CELLS
+            if first + width >= _WRAPPED_LON_CELLS:
+                ranges += [(first, _WRAPPED_LON_CELLS - 1), (0, first + width - _WRAPPED_LON_CELLS)]
+            else:
+                ranges.append((first, first + width))
+        if any(first == 0 for first, _ in ranges):
+            ranges.append((_WRAPPED_LON_CELLS, _WRAPPED_LON_CELLS))  # the longitude of 180 exactly, same as -180
+        keys = (
+            np.array(ranges, dtype=np.int64).reshape(1, -1, 2) +
+            np.array(lat_cells, dtype=np.int64).reshape(-1, 1, 1) * _LON_CELLS
+        ).reshape(-1, 2)
+        first_cells = np.searchsorted(self.cells, keys[:, 0], side="left")
+        last_cells = np.searchsorted(self.cells, keys[:, 1], side="right")
+        return [
+            (int(self.cell_starts[first]), int(self.cell_starts[last]))
+            for first, last in zip(first_cells.tolist(), last_cells.tolist()) if last > first
+        ]
+
+    def nearest(
+            self, latitude: float, longitude: float, max_distance: float,
+            user_id: int | None = None, count_limit: int | None = None
+    ) -> 'NearestLocations':
+        """The locations not further than max_distance meters in increasing distance order, see NearestLocations"""
+        return NearestLocations(self, latitude, longitude, max_distance, user_id, count_limit)
+
+    def query(
+            self, lat_min: float = -90.0, lat_max: float = 90.0, lon_min: float = -180.0, lon_max: float = 180.0,
+            user_id: int | None = None, count_limit: int | None = None
+    ) -> Generator[ParkingLocation, None, None]:
+        """
+        The locations inside the box in the order of the source rows, like ParkingLocationsSource(<the box>).from_csv()
+            yields them. If lon_min > lon_max, the box crosses the 180th meridian and only the locations with
+            lon >= lon_min or lon <= lon_max are yielded, while from_csv() doesn't filter such a box at all
+        """
+        candidates = self._get_candidates(lat_min, lat_max, lon_min, lon_max)
+        scanned_count = len(candidates)
+        if count_limit is not None:
+            candidates = candidates[self.row[candidates] < count_limit]
+        if user_id is not None:
+            users = self.user_id[candidates]
+            candidates = candidates[(users == NO_USER) | (users == user_id)]
+        latitude, longitude = self.latitude[candidates], self.longitude[candidates]
+        mask = np.ones(len(candidates), dtype=bool)
+        for coord, coord_min, coord_max in ((latitude, lat_min, lat_max), (longitude, lon_min, lon_max)):
+            if coord_min > coord_max:
+                mask &= (coord >= coord_min) | (coord <= coord_max)
+            elif coord_max > coord_min:
+                mask &= (coord >= coord_min) & (coord <= coord_max)
+        candidates = candidates[mask]
+        candidates = candidates[np.argsort(self.row[candidates], kind="stable")]
+        metrics.count("rows_scanned", scanned_count)
+        metrics.count("rows_passed_bbox_filter", len(candidates))
+        for latitude, longitude, parking_time, flags in zip(
+                self.latitude[candidates].tolist(), self.longitude[candidates].tolist(),
+                self.parking_time[candidates].tolist(), self.flags[candidates].tolist()
+        ):
+            yield ParkingLocation(
+                latitude, longitude, parking_time, stolen=bool(flags & STOLEN),
+                recovered=bool(flags & RECOVERED) if flags & RECOVERY_KNOWN else None
+            )
+
+
+class NearestLocations:
+    """
+    Iterates over the locations around a point in increasing distance order, visiting the grid cells ring by ring,
+        so only the rings up to the last returned location are read.
+    A ring is wider in longitude cells than in latitude ones, as much as the cells are narrower there,
+        so the number of the rings doesn't grow near the poles. Once a ring covers all the longitudes,
+        the next ones are the whole rows of the cells above and below it.
+    The order is by the haversine distance, which differs from the geodesic one by less than HAVERSINE_ERROR,
+        so the locations a bit further than max_distance may be returned too.
+    """
+    def __init__(
+            self, index: ParkingLocationsIndex, latitude: float, longitude: float, max_distance: float,
+            user_id: int | None = None, count_limit: int | None = None
+    ):
+        self.index = index
+        self.latitude = latitude
+        self.longitude = longitude
+        self.max_distance = max_distance * (1 + HAVERSINE_ERROR)
+        self.user_id = user_id
+        self.count_limit = count_limit
+        self.lat_cell = floor((latitude + 90.0) / CELL_SIZE)
+        self.lon_cell = floor((longitude + 180.0) / CELL_SIZE)
+        # the cells are the narrowest at the latitude closest to the pole the max_distance may reach
+        farthest_latitude = min(90.0, abs(latitude) + degrees(self.max_distance / EARTH_RADIUS))
+        self._lon_ratio = 1 / max(cos(radians(farthest_latitude)), 1 / _WRAPPED_LON_CELLS)
+        # the locations not returned yet sorted by (distance, row), starting from _next
+        self._pending_distance = np.empty(0, dtype=np.float64)
+        self._pending_row = np.empty(0, dtype=np.int64)
+        self._pending_index = np.empty(0, dtype=np.int64)
+        self._next = 0
+        self._ring = -1  # the last visited one
+        self._ring_bound = 0.0
+        # the rings up to _last_ring may have locations within the max_distance
+        self._last_ring = 0
+        while self._get_ring_bound(self._last_ring) <= self.max_distance:
+            self._last_ring += 1
+        self._unvisited_count = sum(
+            end - start for start, end in self._get_square_ranges(self._last_ring)
+        )
+
+    def _get_half_width(self, ring: int) -> int:
+        """The number of the longitude cells of the square of the ring on each side of the center one"""
+        return min(floor(ring * self._lon_ratio), _WRAPPED_LON_CELLS)
+
+    def _covers_all_longitudes(self, ring: int) -> bool:
+        return 2 * self._get_half_width(ring) + 1 >= _WRAPPED_LON_CELLS
+
+    def _get_square_ranges(self, ring: int) -> list[tuple[int, int]]:
+        width = self._get_half_width(ring)
+        return self.index._get_ranges(
+            range(self.lat_cell - ring, self.lat_cell + ring + 1), [(self.lon_cell - width, self.lon_cell + width)]
+        )
+
+    def _get_ring_ranges(self, ring: int) -> list[tuple[int, int]]:
+        """The cells of the square of the given ring that are not in the square of the previous one"""
+        if ring == 0:
+            return self._get_square_ranges(0)
+        width, previous_width = self._get_half_width(ring), self._get_half_width(ring - 1)
+        ranges = self.index._get_ranges(
+            (self.lat_cell - ring, self.lat_cell + ring), [(self.lon_cell - width, self.lon_cell + width)]
+        )
+        if self._covers_all_longitudes(ring - 1):
+            return ranges
+        if self._covers_all_longitudes(ring):
+            side_cells = [(self.lon_cell + previous_width + 1, self.lon_cell - previous_width - 1 + _WRAPPED_LON_CELLS)]
+        else:
+            side_cells = [
+                (self.lon_cell - width, self.lon_cell - previous_width - 1),
+                (self.lon_cell + previous_width + 1, self.lon_cell + width)
+            ]
+        return ranges + self.index._get_ranges(range(self.lat_cell - ring + 1, self.lat_cell + ring), side_cells)
+
+    def _get_ring_bound(self, ring: int) -> float:
+        """The minimal haversine distance to the locations outside the square of the given ring"""
+        lat_min = (self.lat_cell - ring) * CELL_SIZE - 90.0
+        lat_max = (self.lat_cell + ring + 1) * CELL_SIZE - 90.0
+        bounds = [
+            radians(self.latitude - lat_min) if lat_min > -90.0 else inf,
+            radians(lat_max - self.latitude) if lat_max <= 90.0 else inf
+        ]
+        if not self._covers_all_longitudes(ring):
+            width = self._get_half_width(ring)
+            lon_min = (self.lon_cell - width) * CELL_SIZE - 180.0
+            lon_max = (self.lon_cell + width + 1) * CELL_SIZE - 180.0
+            lon_difference = min(self.longitude - lon_min, lon_max - self.longitude, 90.0)
+            # the distance to the great circle of the meridian
+            bounds.append(asin(min(1.0, cos(radians(self.latitude)) * sin(radians(lon_difference)))))
+        return EARTH_RADIUS * max(0.0, min(bounds))
+
+    def _visit_next_ring(self):
+        self._ring += 1
+        ranges = self._get_ring_ranges(self._ring)
+        candidates = np.concatenate([np.arange(start, end) for start, end in ranges]) if ranges else \
+            np.empty(0, dtype=np.int64)
+        self._unvisited_count -= len(candidates)
+        self._ring_bound = self._get_ring_bound(self._ring)
+        metrics.count("rows_scanned", len(candidates))
+        if self.count_limit is not None:
+            candidates = candidates[self.index.row[candidates] < self.count_limit]
+        if self.user_id is not None:
+            users = self.index.user_id[candidates]
+            candidates = candidates[(users == NO_USER) | (users == self.user_id)]
+        latitude, longitude = np.radians(self.index.latitude[candidates]), np.radians(self.index.longitude[candidates])
+        center_latitude, center_longitude = radians(self.latitude), radians(self.longitude)
+        haversine = np.sin((latitude - center_latitude) / 2) ** 2 + \
+            np.cos(latitude) * cos(center_latitude) * np.sin((longitude - center_longitude) / 2) ** 2
+        distances = 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(haversine, 0.0, 1.0)))
+        mask = distances <= self.max_distance
+        metrics.count("rows_passed_bbox_filter", int(np.count_nonzero(mask)))
+        candidates = candidates[mask]
+        distance = np.concatenate((self._pending_distance[self._next:], distances[mask]))
+        row = np.concatenate((self._pending_row[self._next:], self.index.row[candidates]))
+        index = np.concatenate((self._pending_index[self._next:], candidates))
+        order = np.lexsort((row, distance))
+        self._pending_distance, self._pending_row, self._pending_index = distance[order], row[order], index[order]
+        self._next = 0
+
+    def _get_pending_count(self) -> int:
+        return len(self._pending_index) - self._next
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> ParkingLocation:
+        # the closest pending location is the next one, if it's closer than anything in the unvisited rings
+        while self._ring < self._last_ring and (
+                not self._get_pending_count() or self._pending_distance[self._next] > self._ring_bound
+        ):
+            self._visit_next_ring()
+        if not self._get_pending_count():
+            raise StopIteration
+        index = int(self._pending_index[self._next])
+        self._next += 1
+        flags = int(self.index.flags[index])
+        return ParkingLocation(
+            float(self.index.latitude[index]), float(self.index.longitude[index]), int(self.index.parking_time[index]),
+            stolen=bool(flags & STOLEN), recovered=bool(flags & RECOVERED) if flags & RECOVERY_KNOWN else None
+        )
+
+    def get_remaining_bound(self) -> tuple[int, float]:
+        """
+        :return: the maximal number of the locations within the max_distance not returned yet,
+            and the minimal geodesic distance to them
+        """
+        count = self._get_pending_count() + self._unvisited_count
+        distance = self._ring_bound if self._ring < self._last_ring else inf
+        if self._get_pending_count():
+            distance = min(distance, float(self._pending_distance[self._next]))
+        return count, distance * (1 - HAVERSINE_ERROR)
@@ -1,13 +1,40 @@
 import csv
-from typing import Generator
-from random import uniform, choice, randint
+from typing import Generator, Iterable
+from random import uniform, choice, randint, randrange
+from time import perf_counter
 
 from geopy import distance
 
 from . import ParkingLocation, Location, EPSILON
+from .parking_locations_index import ParkingLocationsIndex, NearestLocations
+from .parking_locations_archive import ParkingLocationsArchive
+from utils import metrics
 
 
 DATA_SOURCE_FILE = "./data_with_8users.csv"
+# if set, the locations are taken from this index instead of the DATA_SOURCE_FILE
+_index: ParkingLocationsIndex | None = None
+# built from the DATA_SOURCE_FILE for the queries that need an index when none is set: (path, index)
+_loaded_index: tuple[str, ParkingLocationsIndex] | None = None
+
+
+def set_index(index: ParkingLocationsIndex | None):
+    global _index
+    _index = index
+
+
+def get_index() -> ParkingLocationsIndex | None:
+    return _index
+
+
+def get_or_load_index() -> ParkingLocationsIndex:
+    """The index set by set_index(), otherwise the one built from the DATA_SOURCE_FILE (once per file)"""
+    global _loaded_index
+    if _index is not None:
+        return _index
+    if _loaded_index is None or _loaded_index[0] != DATA_SOURCE_FILE:
+        _loaded_index = DATA_SOURCE_FILE, ParkingLocationsIndex.from_csv(DATA_SOURCE_FILE)
+    return _loaded_index[1]
 
 
 class ParkingLocationsSource:
@@ -31,6 +58,18 @@ class ParkingLocationsSource:
                 *theft_and_recovery
             )
 
+    def random_with_user_id(
+            self, number: int, num_of_users: int
+    ) -> Generator[tuple[ParkingLocation, int], None, None]:
+        """
+        Same as random(), but every location is assigned to one of num_of_users users,
+            like utils.distribute_randomly_between_users() does, without keeping all the data in memory
+        """
+        if num_of_users <= 0:
+            raise ValueError("The number of users must be greater than zero")
+        for location in self.random(number):
+            yield location, randrange(num_of_users)
+
     def from_csv(
             self, path_to_file: str, user_id: int | None = None,
             add_user_id: bool = False, count_limit: int | None = None
@@ -39,32 +78,83 @@ class ParkingLocationsSource:
         "count_limit" parameter is used only for testing purposes and should be removed or replaced in the production
         """
         count = 0
-        with open(path_to_file, 'r') as file:
-            reader = csv.reader(file)
-            for _ in reader:
-                break
-            for line in reader:
-                if count_limit is not None and count >= count_limit:
+        passed_count = 0
+        try:
+            with open(path_to_file, 'r') as file:
+                reader = csv.reader(file)
+                for _ in reader:
                     break
-                count += 1
-                if (user_id is not None) and (len(line) > 5) and (int(line[5]) != user_id):
-                    continue
-                latitude, longitude = float(line[0]), float(line[1])
-                skip = False
-                for coord, coord_min, coord_max in (
-                        (latitude, self.lat_min, self.lat_max), (longitude, self.lon_min, self.lon_max)
-                ):
-                    if coord_min > coord_max and not (coord <= coord_min or coord >= coord_max):
-                        skip = True
-                    elif coord_max > coord_min and (coord < coord_min or coord > coord_max):
-                        skip = True
-                if skip:
-                    continue
-                item = ParkingLocation(
-                    latitude=latitude, longitude=longitude, parking_time=int(line[2]),
-                    stolen=(line[3].lower() == "true"), recovered=(None if not line[4] else (line[4].lower() == "true"))
-                )
-                yield (item, int(line[5])) if add_user_id and len(line) > 5 else item
+                for line in reader:
+                    if count_limit is not None and count >= count_limit:
+                        break
+                    count += 1
+                    if (user_id is not None) and (len(line) > 5) and (int(line[5]) != user_id):
+                        continue
+                    latitude, longitude = float(line[0]), float(line[1])
+                    skip = False
+                    for coord, coord_min, coord_max in (
+                            (latitude, self.lat_min, self.lat_max), (longitude, self.lon_min, self.lon_max)
+                    ):
+                        if coord_min > coord_max and not (coord <= coord_min or coord >= coord_max):
+                            skip = True
+                        elif coord_max > coord_min and (coord < coord_min or coord > coord_max):
+                            skip = True
+                    if skip:
+                        continue
+                    passed_count += 1
+                    item = ParkingLocation(
+                        latitude=latitude, longitude=longitude, parking_time=int(line[2]),
+                        stolen=(line[3].lower() == "true"),
+                        recovered=(None if not line[4] else (line[4].lower() == "true"))
+                    )
+                    yield (item, int(line[5])) if add_user_id and len(line) > 5 else item
+        finally:
+            metrics.count("rows_scanned", count)
+            metrics.count("rows_passed_bbox_filter", passed_count)
+
+    def from_archive(
+            self, path_to_file: str, user_id: int | None = None,
+            add_user_id: bool = False, count_limit: int | None = None
+    ) -> Generator[ParkingLocation, None, None]:
+        """
+        The same as from_csv(), but from a file written by write_archive().
+        Only the blocks of the archive intersecting the box are decompressed.
+        Unlike from_csv(), a box crossing the 180th meridian (lon_min > lon_max) is filtered,
+            like ParkingLocationsIndex.query() does it
+        """
+        yield from ParkingLocationsArchive(path_to_file).query(
+            self.lat_min, self.lat_max, self.lon_min, self.lon_max, user_id, add_user_id, count_limit
+        )
+
+
+def has_user_id_column(path_to_file: str) -> bool:
+    """Whether the CSV file has the "user" column, which from_csv(..., add_user_id=True) returns"""
+    with open(path_to_file, 'r') as file:
+        for line in csv.reader(file):
+            return len(line) > 5
+    return False
+
+
+def write_csv(
+        path_to_file: str, locations: Iterable[ParkingLocation | tuple[ParkingLocation, int]], add_user_id: bool = False
+) -> int:
+    """
+    Write the locations in the format from_csv() reads. If add_user_id is True, the locations must be
+        (ParkingLocation, user_id) tuples, as returned by from_csv(..., add_user_id=True)
+    :return: the number of written locations
+    """
+    count = 0
+    with open(path_to_file, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(["lat", "lon", "parking_time", "stolen", "recovered"] + (["user"] if add_user_id else []))
+        for item in locations:
+            location, user_id = item if add_user_id else (item, None)
+            writer.writerow([
+                location.latitude, location.longitude, location.parking_time, location.stolen,
+                '' if location.recovered is None else location.recovered
+            ] + ([user_id] if add_user_id else []))
+            count += 1
+    return count
 
 
 def get_map_corners(center: Location, radius: int) -> tuple[float, float, float, float]:
@@ -89,8 +179,37 @@ def stream_parking_locations_nearby(
     Radius is in meters.
     "count_limit" parameter is used only for testing purposes and should be removed or replaced in the production
     """
-    source = ParkingLocationsSource(*get_map_corners(center, radius))
-    for location in source.from_csv(DATA_SOURCE_FILE, user_id, count_limit=count_limit):
-        if (center - location) <= radius:
-            if not exclude_center or (center - location) > EPSILON:
-                yield location
+    corners = get_map_corners(center, radius)
+    if _index is not None:
+        locations = metrics.timed_iterator("index_reading", _index.query(*corners, user_id, count_limit))
+    else:
+        locations = metrics.timed_iterator(
+            "csv_reading", ParkingLocationsSource(*corners).from_csv(DATA_SOURCE_FILE, user_id, count_limit=count_limit)
+        )
+    measure = metrics.enabled
+    distance_time = 0.0
+    distance_count = 0
+    try:
+        for location in locations:
+            started = perf_counter() if measure else 0.0
+            location_distance = center - location
+            if measure:
+                distance_time += perf_counter() - started
+                distance_count += 1
+            if location_distance <= radius:
+                if not exclude_center or location_distance > EPSILON:
+                    yield location
+    finally:
+        metrics.count("distance_evaluations", distance_count)
+        metrics.observe("distance_calculation_seconds", distance_time)
+
+
+def find_nearest_parking_locations(
+        center: Location, radius: int, user_id: int | None = None, count_limit: int | None = None
+) -> NearestLocations:
+    """
+    The locations around the center in increasing distance order, up to about the radius (in meters),
+        see NearestLocations. Unlike stream_parking_locations_nearby(), only the cells up to the last taken
+        location are read, so taking the first few locations is cheap in any area
+    """
+    return get_or_load_index().nearest(center.latitude, center.longitude, radius, user_id, count_limit)
@@ -0,0 +1,173 @@
+import os
+import csv
+import json
+from hashlib import blake2b
+from math import floor
+from typing import Final, Iterator
+
+from .parking_locations_repository import get_map_corners
+from . import Location
+
+
+DEFAULT_MAX_CACHE_SIZE: Final = 256 * 1024 * 1024  # bytes
+METERS_IN_LATITUDE_DEGREE: Final = 110574.0  # the minimal one, at the equator
+
+
+def make_key(*parts) -> str:
+    return blake2b(json.dumps(parts, sort_keys=True, default=str).encode(), digest_size=20).hexdigest()
+
+
+class _CellVersions:
+    """
+    Running hashes of the rows inside every cell of the grid, in the order of the file.
+    The version of a cell "as of row N" is its hash before the row N is added, it only depends on the rows before N,
+        so appending data to the end of the file doesn't change the versions the old events depend on
+    """
+    def __init__(self, cell_size: float):
+        self.cell_size = cell_size
+        self.hashes: dict[tuple[int, int], blake2b] = {}
+
+    def get_cell(self, latitude: float, longitude: float) -> tuple[int, int]:
+        return floor(latitude / self.cell_size), floor(longitude / self.cell_size)
+
+    def add(self, latitude: float, longitude: float, row: list[str]):
+        cell = self.get_cell(latitude, longitude)
+        if cell not in self.hashes:
+            self.hashes[cell] = blake2b(digest_size=16)
+        self.hashes[cell].update(','.join(row).encode() + b'\n')
+
+    def get_version(self, cell: tuple[int, int]) -> str:
+        """The hash of the cell's rows added so far"""
+        return self.hashes[cell].hexdigest() if cell in self.hashes else ''
+
+    def _get_cells_around_location(self, location: Location, radius: float) -> set[tuple[int, int]]:
+        lat_min, lat_max, lon_min, lon_max = get_map_corners(location, radius)
+        lat_range = range(self.get_cell(lat_min, 0)[0], self.get_cell(lat_max, 0)[0] + 1)
+        if lon_min <= lon_max:
+            lon_ranges = ((lon_min, lon_max), )
+        else:  # the area crosses the 180th meridian
+            lon_ranges = ((lon_min, 180.0), (-180.0, lon_max))
+        return {
+            (lat_cell, lon_cell)
+            for lat_cell in lat_range
+            for first, last in lon_ranges
+            for lon_cell in range(self.get_cell(0, first)[1], self.get_cell(0, last)[1] + 1)
+        }
+
+    def get_cells_around(self, cell: tuple[int, int], radius: float) -> set[tuple[int, int]]:
+        """
+        All the cells that may contain dots within the radius from any location inside the given cell,
+            which are the cells around its corners and everything between them
+        """
+        result = set()
+        for lat in (cell[0] * self.cell_size, (cell[0] + 1) * self.cell_size):
+            for lon in (cell[1] * self.cell_size, (cell[1] + 1) * self.cell_size):
+                result |= self._get_cells_around_location(
+                    Location(max(-90.0, min(lat, 90.0)), max(-180.0, min(lon, 180.0))), radius
+                )
+        return result
+
+
+class _UserEvents:
+    def __init__(self):
+        self.hash = blake2b(digest_size=16)
+        self.last_row_number = -1
+        self.cells: set[tuple[int, int]] = set()
+
+
+def _read_rows(path_to_file: str) -> Iterator[tuple[int, float, float, list[str]]]:
+    """:return: the row number, the latitude, the longitude and the row itself for every row after the header"""
+    with open(path_to_file, 'r') as file:
+        reader = csv.reader(file)
+        for _ in reader:
+            break
+        for row_number, line in enumerate(reader):
+            yield row_number, float(line[0]), float(line[1]), line
+
+
+def get_users_input_hashes(path_to_file: str, max_distance: float) -> dict[int, str]:
+    """
+    Hash everything the risk tendency and the prediction accuracy of every user depend on:
+        the user's own events (along with their row numbers, since the estimation of every event
+        only uses the rows before it) and the versions of the data around these events.
+    Unlike the estimation itself, these are two passes over the file with no per-row distance calculations:
+        the first one hashes the events of every user and finds their cells and their last rows,
+        the second one takes the versions of the cells around every user at the user's last row.
+        Nothing is kept per row, only per user and per cell.
+    :param path_to_file: a CSV file with the user column
+    :param max_distance: the radius of the area that affects the estimation of the event, in meters
+    """
+    cells = _CellVersions(max(max_distance / METERS_IN_LATITUDE_DEGREE, 0.01))
+    users: dict[int, _UserEvents] = {}
+    for row_number, latitude, longitude, line in _read_rows(path_to_file):
+        user = users.setdefault(int(line[5]), _UserEvents())
+        user.hash.update(f"{row_number},{','.join(line[:5])}\n".encode())
+        user.last_row_number = row_number
+        user.cells.add(cells.get_cell(latitude, longitude))
+    cells_around: dict[tuple[int, int], set[tuple[int, int]]] = {}
+    neighborhoods: dict[int, set[tuple[int, int]]] = {}
+    for user_id, user in users.items():
+        neighborhoods[user_id] = set()
+        for cell in user.cells:
+            if cell not in cells_around:
+                cells_around[cell] = cells.get_cells_around(cell, max_distance)
+            neighborhoods[user_id] |= cells_around[cell]
+    # the estimation of the last event of the user reads the rows before it
+    users_by_last_row = {user.last_row_number: user_id for user_id, user in users.items()}
+    result = {}
+    for row_number, latitude, longitude, line in _read_rows(path_to_file):
+        if len(result) == len(users):
+            break
+        if row_number in users_by_last_row:
+            user_id = users_by_last_row[row_number]
+            result[user_id] = make_key(
+                users[user_id].hash.hexdigest(),
+                sorted((cell, cells.get_version(cell)) for cell in neighborhoods.pop(user_id))
+            )
+        cells.add(latitude, longitude, line[:5])
+    if len(result) < len(users):
+        raise ValueError(f"The file {path_to_file} has been shortened while it was read")
+    return result
+
+
+class PremiumCache:
+    """
+    Per-user results, stored as JSON files named after the key.
+    The least recently used files are removed once the total size exceeds max_size bytes.
+    """
+    def __init__(self, directory: str, max_size: int = DEFAULT_MAX_CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def _get_path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".json")
+
+    def get(self, key: str) -> dict | None:
+        path = self._get_path(key)
+        try:
+            with open(path, 'r') as file:
+                value = json.load(file)
+        except (OSError, ValueError):
+            return None
+        os.utime(path)  # for the eviction
+        return value
+
+    def put(self, key: str, value: dict):
+        path = self._get_path(key)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w') as file:
+            json.dump(value, file)
+        os.replace(temp_path, path)
+
+    def evict(self):
+        entries = [i for i in os.scandir(self.directory) if i.is_file() and i.name.endswith(".json")]
+        total_size = sum(i.stat().st_size for i in entries)
+        for entry in sorted(entries, key=lambda i: i.stat().st_mtime):
+            if total_size <= self.max_size:
+                break
+            total_size -= entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
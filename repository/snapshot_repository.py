@@ -0,0 +1,56 @@
+"""
+A single file with named NumPy arrays and JSON metadata, which can be memory-mapped read-only,
+    so any number of processes can share the same pages of the page cache.
+Layout: magic, header length (8 bytes, little-endian), JSON header, arrays aligned to ALIGNMENT bytes.
+"""
+import os
+import json
+import mmap
+from typing import Final
+
+import numpy as np
+
+
+MAGIC: Final = b"BTSNAP01"
+ALIGNMENT: Final = 64
+
+
+def _align(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_snapshot(path: str, arrays: dict[str, np.ndarray], metadata: dict):
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+    descriptions = {name: {"dtype": array.dtype.str, "shape": list(array.shape)} for name, array in arrays.items()}
+    # the offsets depend on the header length and vice versa, so the header is reserved with the maximal offsets
+    header_size = len(json.dumps({"metadata": metadata, "arrays": descriptions}).encode()) + 32 * (len(arrays) + 1)
+    offset = _align(len(MAGIC) + 8 + header_size)
+    for name, array in arrays.items():
+        descriptions[name]["offset"] = offset
+        offset = _align(offset + array.nbytes)
+    header = json.dumps({"metadata": metadata, "arrays": descriptions}).encode().ljust(header_size)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'wb') as file:
+        file.write(MAGIC + len(header).to_bytes(8, "little") + header)
+        for name, array in arrays.items():
+            file.write(b'\0' * (descriptions[name]["offset"] - file.tell()))
+            file.write(array.tobytes())
+    os.replace(temp_path, path)
+
+
+def read_snapshot(path: str) -> tuple[dict[str, np.ndarray], dict]:
+    """:return: read-only arrays backed by the memory-mapped file, and the metadata"""
+    with open(path, 'rb') as file:
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    if mapped[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"{path} is not a snapshot file")
+    header_size = int.from_bytes(mapped[len(MAGIC):len(MAGIC) + 8], "little")
+    header = json.loads(mapped[len(MAGIC) + 8:len(MAGIC) + 8 + header_size])
+    arrays = {}
+    for name, description in header["arrays"].items():
+        dtype = np.dtype(description["dtype"])
+        count = int(np.prod(description["shape"], dtype=np.int64))
+        arrays[name] = np.frombuffer(
+            mapped, dtype=dtype, count=count, offset=description["offset"]
+        ).reshape(description["shape"])
+    return arrays, header["metadata"]
@@ -1,20 +1,76 @@
 from math import isnan, log10
+from time import perf_counter
 from typing import Iterable, Final
 
 import numpy as np
 
-from utils import tf, EPSILON
+from utils import EPSILON, metrics
 from repository import ParkingLocation
 from repository.insurance_premium_estimation_repository import (UserRiskTendency, MIN_PRICE, MAX_PRICE, LockType,
                                                                 BikeType, FrameMaterial, MAX_SECONDS_IN_MONTH,
                                                                 MIN_LOCK_PRICE, MAX_LOCK_PRICE, WK_DEVICE_VERSIONS,
                                                                 InsuranceInputData)
-from services.parking_locations_service import TheftProbabilityPrediction
+from services.parking_locations_service import TheftProbabilityPrediction, probability_functions
 
 
-MODEL: Final = tf.keras.models.load_model('result-0.5339_on50k.keras')
+MODEL_FILE: Final = 'result-0.5339_on50k.keras'
+_ACTIVATIONS: Final = {
+    "linear": lambda x: x,
+    "relu": lambda x: np.maximum(x, 0.0),
+    "leaky_relu": lambda x: np.where(x > 0.0, x, x * np.float32(0.2)),  # the default alpha of tf.nn.leaky_relu
+    "sigmoid": lambda x: 1.0 / (1.0 + np.exp(-x)),
+    "tanh": np.tanh,
+}
+_model = None  # loaded on the first prediction, unless set_model() was called before
 
 
+class DenseNetwork:
+    """
+    Inference of a Sequential model consisting of Dense and Dropout layers with NumPy only,
+        so the processes that use the exported weights don't need to import TensorFlow
+    """
+    def __init__(self, layers: list[tuple[np.ndarray, np.ndarray, str]]):
+        """:param layers: kernel, bias and activation name of every Dense layer"""
+        self.layers = layers
+
+    def predict(self, x, verbose: int = 0) -> np.ndarray:
+        """Same interface as the Keras one"""
+        result = np.asarray(x, dtype=np.float32)
+        for kernel, bias, activation in self.layers:
+            result = _ACTIVATIONS[activation](result @ kernel + bias)
+        return result
+
+
+def export_dense_network(model) -> DenseNetwork | None:
+    """:return: None if the model has layers DenseNetwork doesn't support"""
+    layers = []
+    for layer in model.layers:
+        layer_type = type(layer).__name__
+        if layer_type in ("Dropout", "InputLayer"):  # Dropout does nothing during inference
+            continue
+        config = layer.get_config()
+        if layer_type != "Dense" or config["activation"] not in _ACTIVATIONS or not config["use_bias"]:
+            return None
+        kernel, bias = layer.get_weights()
+        layers.append((kernel.astype(np.float32), bias.astype(np.float32), config["activation"]))
+    return DenseNetwork(layers)
+
+
+def get_model():
+    global _model
+    if _model is None:
+        from utils import tf
+        _model = tf.keras.models.load_model(MODEL_FILE)
+    return _model
+
+
+def set_model(model):
+    """A Keras model or anything else with the same predict() method, e.g. DenseNetwork"""
+    global _model
+    _model = model
+
+
+@metrics.timed("get_user_risk_tendency")
 def get_user_risk_tendency(
         locations_with_predictions: list[tuple[ParkingLocation, TheftProbabilityPrediction]]
 ) -> UserRiskTendency:
@@ -29,11 +85,11 @@ def get_user_risk_tendency(
     recovery_data = [
         location.recovered for location, prediction in locations_with_predictions if location.recovered is not None
     ]
-    parking_time_theft_data = [
-        prediction.probability_function(location.parking_time)
-        for location, prediction in locations_with_predictions
-        if prediction.regression_params is not None
-    ]
+    with_regression = [(location, prediction) for location, prediction in locations_with_predictions
+                       if prediction.regression_params is not None]
+    parking_time_theft_data = probability_functions(
+        [prediction for _, prediction in with_regression], [location.parking_time for location, _ in with_regression]
+    ).tolist()
     return UserRiskTendency(
         avg_theft_probability_prediction=(
                 sum(theft_probability_data) / len(theft_probability_data)
@@ -126,6 +182,13 @@ def _simple_insurance_premium_prediction(data: InsuranceInputData) -> float | No
     return max(round(insurance_cost, 2), 5.0)
 
 
+@metrics.timed("insurance_premium_prediction")
 def insurance_premium_prediction(data: Iterable[InsuranceInputData]) -> list[float | None]:
+    started = perf_counter()
     insurance_data = prepare_insurance_data(i.as_list_of_values() for i in data)
-    return [max(0.0, round(float(i[0]), 2)) for i in MODEL.predict(insurance_data)]
+    metrics.observe("insurance_data_preparation_seconds", perf_counter() - started)
+    metrics.observe("model_batch_size", len(insurance_data))
+    started = perf_counter()
+    predictions = get_model().predict(insurance_data, verbose=0)  # stdout may be used for the results
+    metrics.observe("model_prediction_seconds", perf_counter() - started)
+    return [max(0.0, round(float(i[0]), 2)) for i in predictions]
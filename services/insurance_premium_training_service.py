@@ -0,0 +1,256 @@
+"""
+Model selection for the insurance premium model: the architecture of ML.ipynb trained with several configurations
+    at once, one process per configuration. The encoded dataset is generated (or loaded) once and shared
+    between the processes via shared memory, every process is limited to the given number of threads,
+    so that the processes don't fight for the CPU cores.
+"""
+import os
+from math import floor, isfinite
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+from time import perf_counter
+from typing import Final, Callable
+
+import numpy as np
+
+from utils import ReprMixin
+from repository.insurance_premium_estimation_repository import generate_random_insurance_data, seed_random_generators
+from services.insurance_premium_estimation_service import (prepare_insurance_data,
+                                                           _simple_insurance_premium_prediction)
+
+
+DEFAULT_DATASET_SIZE: Final = 50000
+DEFAULT_VALIDATION_SPLIT: Final = 0.2
+DEFAULT_MAX_EPOCHS: Final = 128
+DEFAULT_PATIENCE: Final = 20
+INFERENCE_BATCH_SIZE: Final = 256
+INFERENCE_REPEATS: Final = 20
+
+
+class TrainingConfiguration(ReprMixin):
+    def __init__(
+            self, layers: list[int], batch_size: int = 64, learning_rate: float = 0.0011, dropout: float = 0.1
+    ):
+        """
+        :param layers: the widths of the hidden Dense layers, the output layer is added automatically
+        :param dropout: the rate of the Dropout layer after the widest hidden layer, 0 for no Dropout
+        """
+        self.layers = [*layers]
+        self.batch_size = batch_size
+        self.learning_rate = learning_rate
+        self.dropout = dropout
+
+    def as_dict(self) -> dict:
+        return {**self.__dict__}
+
+
+def get_default_configurations(input_size: int) -> list[TrainingConfiguration]:
+    """Variations of the architecture of the current model (ML.ipynb)"""
+    shapes = ((4, 8, 16, 8, 4), (4, 8, 4), (8, 16, 8), (16, 16))
+    return [
+        TrainingConfiguration([input_size * i for i in shape], batch_size, learning_rate)
+        for shape in shapes for batch_size in (64, 256) for learning_rate in (0.0011, 0.003)
+    ]
+
+
+def generate_dataset(size: int, seed: int | None = None) -> tuple[np.ndarray, np.ndarray]:
+    """:return: the encoded inputs and the premiums of the simple model, like in ML.ipynb"""
+    if seed is not None:
+        seed_random_generators(seed)
+    data_x, data_y = zip(*(
+        (i.as_list_of_values(), _simple_insurance_premium_prediction(i))
+        for i in (generate_random_insurance_data() for _ in range(size))
+    ))
+    x, y = prepare_insurance_data(data_x, [*data_y])
+    return x.astype(np.float32), y.astype(np.float32)
+
+
+def load_or_generate_dataset(
+        path: str | None, size: int = DEFAULT_DATASET_SIZE, seed: int | None = None
+) -> tuple[np.ndarray, np.ndarray]:
+    """The dataset is saved to the path (.npz) if the file doesn't exist yet"""
+    if path and os.path.exists(path):
+        with np.load(path) as dataset:
+            return dataset["x"], dataset["y"]
+    x, y = generate_dataset(size, seed)
+    if path:
+        with open(f"{path}.{os.getpid()}.tmp", 'wb') as file:
+            np.savez(file, x=x, y=y)
+        os.replace(f"{path}.{os.getpid()}.tmp", path)
+    return x, y
+
+
+class SharedArrays:
+    """NumPy arrays in shared memory, the description can be sent to other processes to attach them"""
+    def __init__(self, arrays: dict[str, np.ndarray]):
+        self.memory: dict[str, SharedMemory] = {}
+        self.description: dict[str, tuple[str, tuple, str]] = {}
+        for name, array in arrays.items():
+            memory = SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, array.dtype, buffer=memory.buf)[...] = array
+            self.memory[name] = memory
+            self.description[name] = (memory.name, array.shape, array.dtype.str)
+
+    def close(self):
+        for memory in self.memory.values():
+            memory.close()
+            memory.unlink()
+
+    def __enter__(self) -> 'SharedArrays':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _attach(description: dict[str, tuple[str, tuple, str]]) -> tuple[list[SharedMemory], dict[str, np.ndarray]]:
+    """The memory objects have to be kept while the arrays are used"""
+    memory = {name: SharedMemory(memory_name) for name, (memory_name, _, _) in description.items()}
+    return [*memory.values()], {
+        name: np.ndarray(shape, np.dtype(dtype), buffer=memory[name].buf)
+        for name, (_, shape, dtype) in description.items()
+    }
+
+
+def _build_model(input_size: int, configuration: TrainingConfiguration):
+    from utils import tf
+    layers = [tf.keras.layers.Input((input_size, ))]
+    widest = configuration.layers.index(max(configuration.layers)) if configuration.layers else -1
+    for number, width in enumerate(configuration.layers):
+        layers.append(tf.keras.layers.Dense(width, activation="leaky_relu"))
+        if number == widest and configuration.dropout > 0:
+            layers.append(tf.keras.layers.Dropout(configuration.dropout))
+    layers.append(tf.keras.layers.Dense(1, activation="leaky_relu"))
+    model = tf.keras.Sequential(layers)
+    model.compile(
+        tf.keras.optimizers.Adam(learning_rate=configuration.learning_rate),
+        loss=tf.keras.losses.MeanSquaredError(),
+        metrics=[tf.metrics.MeanAbsoluteError(name='err')]
+    )
+    return model
+
+
+def _measure_inference(model, x: np.ndarray) -> float:
+    """:return: the median time of a prediction of INFERENCE_BATCH_SIZE records, the same way the service does it"""
+    batch = np.array(x[:INFERENCE_BATCH_SIZE])
+    model.predict(batch, verbose=0)  # warm up
+    durations = []
+    for _ in range(INFERENCE_REPEATS):
+        started = perf_counter()
+        model.predict(batch, verbose=0)
+        durations.append(perf_counter() - started)
+    return float(np.median(durations))
+
+
+def _init_worker(threads: int):
+    """Has to be done before TensorFlow executes anything in the process"""
+    from utils import tf
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(threads)
+
+
+def _train_candidate(
+        number: int, configuration: TrainingConfiguration, dataset: dict[str, tuple[str, tuple, str]],
+        max_epochs: int, patience: int, validation_split: float, seed: int | None, output_dir: str
+) -> dict:
+    """Runs in a worker process. The model is saved into the output_dir, so the best one is not trained twice"""
+    from utils import tf
+    tf.keras.backend.clear_session()  # the worker may have trained another candidate before
+    if seed is not None:
+        tf.keras.utils.set_random_seed(seed + number)
+    memory, arrays = _attach(dataset)
+    try:
+        x, y = arrays["x"], arrays["y"]
+        model = _build_model(x.shape[1], configuration)
+        started = perf_counter()
+        history = model.fit(
+            x, y, epochs=max_epochs, batch_size=configuration.batch_size, shuffle=True, verbose=0,
+            validation_split=validation_split,
+            callbacks=[tf.keras.callbacks.EarlyStopping(
+                monitor='val_loss', min_delta=0.0001, patience=patience, restore_best_weights=True
+            )]
+        )
+        training_seconds = perf_counter() - started
+        val_losses = np.array(history.history['val_loss'])
+        best_epoch = int(np.argmin(np.where(np.isfinite(val_losses), val_losses, np.inf)))
+        # EarlyStopping restores the best weights only if it stops the training, so the saved model is evaluated,
+        #     on the same validation part as model.fit() uses
+        split_at = floor(len(x) * (1.0 - validation_split))
+        val_loss, val_err = model.evaluate(x[split_at:], y[split_at:], verbose=0)
+        model_path = os.path.join(output_dir, f"candidate-{number}.keras")
+        model.save(model_path)
+        return {
+            "number": number,
+            "configuration": configuration.as_dict(),
+            "val_loss": float(val_loss),
+            "val_err": float(val_err),
+            "epochs": len(val_losses),
+            "best_epoch": best_epoch + 1,
+            "parameters": int(model.count_params()),
+            "training_seconds": training_seconds,
+            "inference_seconds": _measure_inference(model, x),
+            "inference_batch_size": min(INFERENCE_BATCH_SIZE, len(x)),
+            "model_path": model_path
+        }
+    finally:
+        del arrays
+        for i in memory:
+            i.close()
+
+
+def run_training_sweep(
+        configurations: list[TrainingConfiguration], x: np.ndarray, y: np.ndarray, model_file: str,
+        workers: int | None = None, threads: int = 1, max_epochs: int = DEFAULT_MAX_EPOCHS,
+        patience: int = DEFAULT_PATIENCE, validation_split: float = DEFAULT_VALIDATION_SPLIT,
+        seed: int | None = None, on_result: Callable[[dict], None] | None = None
+) -> list[dict]:
+    """
+    Train every configuration and save the model with the lowest validation loss into the model_file,
+        so that insurance_premium_estimation_service can load it.
+    :param workers: the number of processes, by default as many as fit into the CPU cores with the given threads
+    :param threads: the number of TensorFlow threads per process
+    :param on_result: called with every result as soon as it's ready
+    :return: the results of all the candidates sorted by the validation loss,
+        the errors and the diverged candidates are at the end
+    """
+    workers = workers or max(1, (os.cpu_count() or 1) // threads)
+    results = []
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(model_file))) as output_dir, \
+            SharedArrays({"x": x, "y": y}) as dataset, \
+            ProcessPoolExecutor(
+                min(workers, len(configurations)) or 1, mp_context=get_context("spawn"),
+                initializer=_init_worker, initargs=(threads, )
+            ) as executor:
+        futures = {
+            executor.submit(
+                _train_candidate, number, configuration, dataset.description,
+                max_epochs, patience, validation_split, seed, output_dir
+            ): (number, configuration)
+            for number, configuration in enumerate(configurations)
+        }
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                number, configuration = futures[future]
+                result = {
+                    "number": number, "configuration": configuration.as_dict(), "error": f"{type(e).__name__}: {e}"
+                }
+            if "error" not in result and not isfinite(result["val_loss"]):
+                result["error"] = f"The training diverged, the validation loss is {result['val_loss']}"
+                result["val_loss"] = result["val_err"] = None  # NaN is not valid JSON
+            results.append(result)
+            if on_result is not None:
+                on_result(result)
+        # only the finite losses are ranked, NaN can't be compared
+        results.sort(key=lambda i: ("error" in i, i["val_loss"] if "error" not in i else 0.0, i["number"]))
+        if results and "error" not in results[0]:
+            temp_path = f"{model_file}.{os.getpid()}.tmp.keras"
+            shutil.copyfile(results[0]["model_path"], temp_path)
+            os.replace(temp_path, model_file)
+    for result in results:
+        result.pop("model_path", None)
+    return results
@@ -1,10 +1,15 @@
-from math import nan, isnan
+from math import nan, isnan, isfinite
+from time import perf_counter
+from typing import Final, Sequence
 
-from statsmodels.regression.linear_model import WLS
-from statsmodels.api import add_constant
+import numpy as np
 
 from repository import parking_locations_repository, Location, ParkingLocation, EPSILON
-from utils import ReprMixin
+from utils import ReprMixin, metrics
+
+
+# POWER_OF_DISTANCE: Final = 1.432
+POWER_OF_DISTANCE: Final = 1.5
 
 
 class DotAndItsImportance(ReprMixin):
@@ -34,14 +39,17 @@ class LinearRegressionParams(ReprMixin):
         self.a = a
         self.b = b
 
-    def function(self, x):
+    def function(self, x: int | float | Sequence | np.ndarray) -> float | np.ndarray:
+        """x may be a number or an array of numbers"""
+        if not np.isscalar(x):
+            x = np.asarray(x, dtype=np.float64)
         return self.a * x + self.b
 
 
 class TheftProbabilityPrediction(ReprMixin):
     def __init__(
             self, location: Location, theft_probability: float, recovery_probability: float,
-            used_dots: int, regression_params: LinearRegressionParams | None
+            used_dots: int, regression_params: LinearRegressionParams | None, truncation_bound: float | None = None
     ):
         """
         :param theft_probability: the probability of bike theft in the given location
@@ -49,16 +57,23 @@ class TheftProbabilityPrediction(ReprMixin):
         :param used_dots: the number of dots used for this prediction
         :param regression_params: a linear function that generates a theft probability  in the given location,
             depending on the parking time. None if the get_probability_function is False
+        :param truncation_bound: if the number of the used dots was bounded (see estimate_theft_probability),
+            the maximal total importance of the dots that were not used, relative to the importance of the used ones
         """
         self.location = Location(*location.coordinates)
         self.theft_probability = theft_probability
         self.recovery_probability = recovery_probability
         self.used_dots = used_dots
         self.regression_params = regression_params
+        self.truncation_bound = truncation_bound
 
-    def probability_function(self, time: int) -> float | None:
+    def probability_function(self, time: int | Sequence | np.ndarray) -> float | np.ndarray | None:
+        """The time may be an array of times, then an array of probabilities is returned"""
         if not self.regression_params or self.regression_params.a < 0:
             return None
+        if not np.isscalar(time):
+            time = np.asarray(time, dtype=np.float64)
+            return _clip_probabilities(self.regression_params.function(time), time)
         raw_prediction = self.regression_params.function(time)
         if raw_prediction < 0.0 or time <= 0:
             return 0.0
@@ -67,6 +82,33 @@ class TheftProbabilityPrediction(ReprMixin):
         return raw_prediction
 
 
+def _clip_probabilities(raw_predictions: np.ndarray, times: np.ndarray) -> np.ndarray:
+    """The same as TheftProbabilityPrediction.probability_function does with a single value"""
+    return np.where(times <= 0, 0.0, np.clip(raw_predictions, 0.0, 1.0))
+
+
+def probability_functions(
+        predictions: Sequence[TheftProbabilityPrediction], times: Sequence | np.ndarray, table: bool = False
+) -> np.ndarray:
+    """
+    Evaluate the probability functions of many predictions at once.
+    :param times: parking times in seconds
+    :param table: if True, every function is evaluated at every time, and the result has the shape
+        (len(predictions), len(times)). Otherwise, the times are paired with the predictions (one time per prediction)
+    :return: the probabilities, NaN for the predictions without a probability function
+    """
+    a = np.array([
+        i.regression_params.a if i.regression_params and i.regression_params.a >= 0 else nan for i in predictions
+    ], dtype=np.float64)
+    b = np.array([i.regression_params.b if i.regression_params else nan for i in predictions], dtype=np.float64)
+    times = np.asarray(times, dtype=np.float64)
+    if table:
+        a, b, times = a[:, np.newaxis], b[:, np.newaxis], times[np.newaxis, :]
+    elif len(times) != len(predictions):
+        raise ValueError("The number of times must be the same as the number of predictions")
+    return np.where(np.isnan(a) | np.isnan(b), nan, _clip_probabilities(a * times + b, times))
+
+
 class PredictionAccuracy(ReprMixin):
     def __init__(
             self, theft_probability_prediction_accuracy: float | None,
@@ -84,7 +126,7 @@ class PredictionAccuracy(ReprMixin):
         self.parking_time_theft_probability_prediction_std = parking_time_theft_probability_prediction_std
 
 
-def _get_max_distance(power_of_distance):
+def get_max_distance(power_of_distance: float) -> float:
     """Calculate the distance at which the importance of the data is less than Epsilon"""
     return EPSILON ** (-1 / power_of_distance)
 
@@ -93,9 +135,11 @@ def _get_error(value: float, biased_value: float):
     return min(1.0, abs(biased_value - value) / value)
 
 
+@metrics.timed("estimate_theft_probability")
 def estimate_theft_probability(
         location: Location, power_of_distance: float = 1.4,
-        get_probability_function: bool = False, get_all_dots: bool = False, count_limit: int | None = None
+        get_probability_function: bool = False, get_all_dots: bool = False, count_limit: int | None = None,
+        max_dots: int | None = None, min_relative_weight: float | None = None
 ) -> tuple[TheftProbabilityPrediction, list[DotAndItsImportance] | None]:
     """
     Calculate the approximate probability of the bicycle theft at the given location,
@@ -106,6 +150,12 @@ def estimate_theft_probability(
     :param get_probability_function: if set to True, the probability function parameters will be calculated.
     :param get_all_dots: Return list of all locations along with the TheftProbabilityPrediction() object.
     :param count_limit: if passed, the function will read not more than count_limit values from the database
+    :param max_dots: if passed, only this number of the closest dots is used
+    :param min_relative_weight: if passed, the closest dots are used until the importance of all the other ones
+        can't be more than this part of the importance of the used ones
+    If max_dots or min_relative_weight is passed, the dots are taken from the index in increasing distance order
+        (the index is built from the DATA_SOURCE_FILE if none is set), so the time doesn't depend on the density
+        of the dots around, and the prediction has the truncation_bound.
     :return: a TheftProbabilityPrediction() object and, optionally, all the dots, used for the prediction,
         along with their weights. If there are no dots around the location,
         (TheftProbabilityPrediction(location, nan, nan, 0, None), None) will be returned.
@@ -113,19 +163,38 @@ def estimate_theft_probability(
     """
     if power_of_distance < 1.0 or power_of_distance > 32.0:
         raise ValueError("The allowed values for power_of_distance are between 1.0 and 32.0")
+    if not -90.0 <= location.latitude <= 90.0:
+        raise ValueError("The latitude has to be between -90.0 and 90.0")
+    if not isfinite(location.longitude):
+        raise ValueError("The longitude has to be a finite number")
     if count_limit is not None and (count_limit < 0):
         raise ValueError("The count_limit parameter has to be greater or equal to zero")
+    if max_dots is not None and max_dots < 1:
+        raise ValueError("The max_dots parameter has to be greater than zero")
+    if min_relative_weight is not None and min_relative_weight < 0.0:
+        raise ValueError("The min_relative_weight parameter has to be greater or equal to zero")
+    bounded = max_dots is not None or min_relative_weight is not None
+    truncation_bound = None
     sum_of_importance = 0.0
     sum_of_stolen_forever = 0.0  # also about importance
     sum_of_stolen_and_recovered = 0.0  # also about importance
     dots_count = 0  # just a counter
     all_dots_with_importance = []
-    max_locations_distance = _get_max_distance(power_of_distance)
-    for dot in parking_locations_repository.stream_parking_locations_nearby(
+    max_locations_distance = get_max_distance(power_of_distance)
+    if bounded:
+        dots = parking_locations_repository.find_nearest_parking_locations(
+            location, max_locations_distance, count_limit=count_limit
+        )
+    else:
+        dots = parking_locations_repository.stream_parking_locations_nearby(
             location, max_locations_distance, exclude_center=False, count_limit=count_limit
-    ):
+        )
+    for dot in metrics.timed_iterator("neighbors_search", dots):
+        dot_distance = dot - location
+        if bounded and dot_distance > max_locations_distance:
+            continue
         dots_count += 1
-        dot_importance = 1 / (max(dot - location, 3) ** power_of_distance)  # everything closer than 3m is the same
+        dot_importance = 1 / (max(dot_distance, 3) ** power_of_distance)  # everything closer than 3m is the same
         sum_of_importance += dot_importance
         if dot.stolen and dot.recovered:
             sum_of_stolen_and_recovered += dot_importance
@@ -134,21 +203,39 @@ def estimate_theft_probability(
         dot_and_importance = DotAndItsImportance(dot, dot_importance)
         if get_probability_function or get_all_dots:
             all_dots_with_importance.append(dot_and_importance)
+        if bounded:
+            remaining_count, remaining_distance = dots.get_remaining_bound()
+            truncation_bound = remaining_count / max(remaining_distance, 3) ** power_of_distance / sum_of_importance
+            if (max_dots is not None and dots_count >= max_dots) or \
+                    (min_relative_weight is not None and truncation_bound < min_relative_weight):
+                metrics.count("truncated_queries")
+                break
+    else:
+        if bounded:  # all the dots within the distance are used
+            truncation_bound = 0.0
+    metrics.observe("dots_per_query", dots_count)
+    metrics.count("distance_evaluations", dots_count)  # the importance of every dot
     if dots_count == 0:
-        return TheftProbabilityPrediction(location, nan, nan, 0, None), None
+        return TheftProbabilityPrediction(location, nan, nan, 0, None, truncation_bound), None
     probability_of_theft = (sum_of_stolen_forever + sum_of_stolen_and_recovered) / sum_of_importance
     probability_of_recovery = sum_of_stolen_and_recovered / (sum_of_stolen_forever + sum_of_stolen_and_recovered) \
         if (sum_of_stolen_forever + sum_of_stolen_and_recovered) > 0.0 else nan
     regression_params = None
     if get_probability_function:
+        started = perf_counter()
         weights = [i.importance for i in all_dots_with_importance]
         y_values = [int(i.dot.stolen) for i in all_dots_with_importance]
         x_values = [int(i.dot.parking_time) for i in all_dots_with_importance]
+        # statsmodels takes a second to import, so the processes that never fit anything don't import it
+        from statsmodels.regression.linear_model import WLS
+        from statsmodels.api import add_constant
         probability_func_parameters = WLS(y_values, add_constant(x_values), weights=weights).fit().params
         if len(probability_func_parameters) > 1 and probability_func_parameters[1] >= 0.0:
             regression_params = LinearRegressionParams(probability_func_parameters[1], probability_func_parameters[0])
+        metrics.count("regression_fits")
+        metrics.observe("regression_seconds", perf_counter() - started)
     return TheftProbabilityPrediction(
-        location, probability_of_theft, probability_of_recovery, dots_count, regression_params
+        location, probability_of_theft, probability_of_recovery, dots_count, regression_params, truncation_bound
     ), (all_dots_with_importance if get_all_dots else None)
 
 
@@ -165,11 +252,15 @@ def get_prediction_accuracy(
         for location, prediction in locations_with_predictions
         if not isnan(prediction.recovery_probability) and location.recovered is not None
     ]
-    parking_time_theft_data = [
-        (location.stolen, prediction.probability_function(location.parking_time))
-        for location, prediction in locations_with_predictions
-        if prediction.regression_params is not None
-    ]
+    with_regression = [(location, prediction) for location, prediction in locations_with_predictions
+                       if prediction.regression_params is not None]
+    parking_time_theft_data = [*zip(
+        (location.stolen for location, _ in with_regression),
+        probability_functions(
+            [prediction for _, prediction in with_regression],
+            [location.parking_time for location, _ in with_regression]
+        ).tolist()
+    )]
     avg_theft_accuracy = avg_recovery_accuracy = avg_parking_time_theft_accuracy = None
     avg_theft_std = avg_recovery_std = avg_parking_time_theft_std = None
     if theft_data:
@@ -0,0 +1,104 @@
+"""
+The "warm snapshot": everything a worker needs to answer queries, in a single memory-mapped file.
+Loading it takes milliseconds, since nothing is parsed and TensorFlow is not imported
+    (unless the model has layers DenseNetwork doesn't support, then it is loaded from the model file as usual).
+"""
+import os
+import warnings
+from time import perf_counter
+from typing import Final
+
+import numpy as np
+
+from utils import get_file_hash
+from repository import parking_locations_repository
+from repository.parking_locations_index import ParkingLocationsIndex, STOLEN, RECOVERED
+from repository.snapshot_repository import write_snapshot, read_snapshot
+from services import insurance_premium_estimation_service
+
+
+SNAPSHOT_FORMAT_VERSION: Final = 2  # 2: the finer cells of the ParkingLocationsIndex
+
+
+def create_snapshot(path: str, data_file: str | None = None, model_file: str | None = None) -> dict:
+    """:return: the metadata of the snapshot"""
+    from utils import tf
+    data_file = data_file or parking_locations_repository.DATA_SOURCE_FILE
+    model_file = model_file or insurance_premium_estimation_service.MODEL_FILE
+    index = ParkingLocationsIndex.from_csv(data_file)
+    arrays = {f"locations.{name}": array for name, array in index.arrays().items()}
+    metadata = {
+        "format_version": SNAPSHOT_FORMAT_VERSION,
+        **_describe_source("data", data_file),
+        **_describe_source("model", model_file),
+        "aggregates": {
+            "locations": len(index),
+            "stolen": int(np.count_nonzero(index.flags & STOLEN)),
+            "recovered": int(np.count_nonzero(index.flags & RECOVERED)),
+            "cells": len(index.cells),
+            "bbox": [
+                float(index.latitude.min()), float(index.latitude.max()),
+                float(index.longitude.min()), float(index.longitude.max())
+            ] if len(index) else None
+        }
+    }
+    network = insurance_premium_estimation_service.export_dense_network(tf.keras.models.load_model(model_file))
+    if network is not None:
+        metadata["model_activations"] = []
+        for number, (kernel, bias, activation) in enumerate(network.layers):
+            arrays[f"model.{number}.kernel"], arrays[f"model.{number}.bias"] = kernel, bias
+            metadata["model_activations"].append(activation)
+    write_snapshot(path, arrays, metadata)
+    return metadata
+
+
+def _describe_source(kind: str, source_file: str) -> dict:
+    """The size and the modification time are taken before the hash, so a change during the hashing is noticed"""
+    stat = os.stat(source_file)
+    return {
+        f"{kind}_file": os.path.abspath(source_file),
+        f"{kind}_file_size": stat.st_size,
+        f"{kind}_file_mtime_ns": stat.st_mtime_ns,
+        f"{kind}_file_hash": get_file_hash(source_file)
+    }
+
+
+def _warn_if_sources_changed(path: str, metadata: dict):
+    """
+    The source files are hashed again only if their size or modification time differs from the recorded ones,
+        so the check doesn't read them on every load. The files that don't exist anymore are not checked
+    """
+    for kind in ("data", "model"):
+        source_file = metadata.get(f"{kind}_file")
+        if source_file is None or not os.path.exists(source_file):
+            continue  # the snapshots created before the sources were recorded can't be checked
+        stat = os.stat(source_file)
+        if (stat.st_size, stat.st_mtime_ns) == (metadata[f"{kind}_file_size"], metadata[f"{kind}_file_mtime_ns"]):
+            continue
+        if get_file_hash(source_file) != metadata[f"{kind}_file_hash"]:
+            warnings.warn(f"The {kind} file {source_file} has changed since the snapshot {path} was created")
+
+
+def load_snapshot(path: str, check_sources: bool = True) -> dict:
+    """
+    Make the repository and the insurance service use the data from the snapshot.
+    :param check_sources: warn if the data file or the model file differs from the one the snapshot was created from,
+        not included in the loading time
+    :return: the metadata of the snapshot, with the loading time added
+    """
+    started = perf_counter()
+    arrays, metadata = read_snapshot(path)
+    if metadata.get("format_version") != SNAPSHOT_FORMAT_VERSION:
+        raise ValueError(f"Unsupported snapshot format version: {metadata.get('format_version')}")
+    parking_locations_repository.set_index(ParkingLocationsIndex(
+        **{name: arrays[f"locations.{name}"] for name in ParkingLocationsIndex.ARRAY_NAMES}
+    ))
+    if "model_activations" in metadata:
+        insurance_premium_estimation_service.set_model(insurance_premium_estimation_service.DenseNetwork([
+            (arrays[f"model.{number}.kernel"], arrays[f"model.{number}.bias"], activation)
+            for number, activation in enumerate(metadata["model_activations"])
+        ]))
+    metadata["loading_seconds"] = perf_counter() - started
+    if check_sources:
+        _warn_if_sources_changed(path, metadata)
+    return metadata
@@ -1,14 +1,22 @@
 from typing import Final
 from random import shuffle
+from hashlib import blake2b
 import os
 
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
-import tensorflow as tf
 
 
 EPSILON: Final = 0.000001
 
 
+def __getattr__(name):
+    """TensorFlow takes seconds to import, so it's imported on the first "from utils import tf" only"""
+    if name == "tf":
+        import tensorflow
+        return tensorflow
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 class ReprMixin:
     def __str__(self):
         arguments = ', '.join(f'{arg_name}={getattr(self, arg_name)}' for arg_name in self.__dict__)
@@ -28,3 +36,11 @@ def distribute_randomly_between_users(data: list, num_of_users: int) -> list:
             user_number = 0
     shuffle(users)
     return zip(data, users)
+
+
+def get_file_hash(path_to_file: str) -> str:
+    digest = blake2b(digest_size=20)
+    with open(path_to_file, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -0,0 +1,161 @@
+"""
+Opt-in counters and timers for the hot paths.
+Enabled by enable(), by the METRICS environment variable or by the METRICS_OUTPUT one
+    (main.py writes the metrics to that file at the end).
+When disabled, every helper returns right after checking the "enabled" flag.
+Metrics of ProcessPoolExecutor workers are sent back with pop_snapshot() and added to the parent's ones with merge().
+"""
+import json
+from os import environ
+from functools import wraps
+from time import perf_counter
+from typing import Final, Iterable, Iterator, TypeVar
+
+
+T = TypeVar("T")
+METRICS_ENV: Final = "METRICS"
+METRICS_OUTPUT_ENV: Final = "METRICS_OUTPUT"
+PROMETHEUS_PREFIX: Final = "bicycle_theft_"
+
+enabled = bool(environ.get(METRICS_ENV) or environ.get(METRICS_OUTPUT_ENV))
+_counters: dict[str, float] = {}
+_summaries: dict[str, list[float]] = {}  # name: [count, sum, min, max]
+
+
+def enable():
+    """Spawned worker processes read the environment, so they will be instrumented as well"""
+    global enabled
+    enabled = True
+    environ[METRICS_ENV] = "1"
+
+
+def disable():
+    global enabled
+    enabled = False
+    environ.pop(METRICS_ENV, None)
+
+
+def reset():
+    _counters.clear()
+    _summaries.clear()
+
+
+def count(name: str, value: int | float = 1):
+    if not enabled:
+        return
+    _counters[name] = _counters.get(name, 0) + value
+
+
+def observe(name: str, value: int | float):
+    """Add a value (a duration in seconds, a batch size, etc.) to the summary with the given name"""
+    if not enabled:
+        return
+    summary = _summaries.get(name)
+    if summary is None:
+        _summaries[name] = [1, value, value, value]
+    else:
+        summary[0] += 1
+        summary[1] += value
+        summary[2] = min(summary[2], value)
+        summary[3] = max(summary[3], value)
+
+
+def timed(name: str):
+    """Decorator, observes the duration of every call in the "<name>_seconds" summary"""
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            started = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                observe(name + "_seconds", perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+def timed_iterator(name: str, iterable: Iterable[T]) -> Iterable[T]:
+    """
+    Observe the time spent on producing the items (not on consuming them) in the "<name>_seconds" summary,
+        once the iteration is over
+    """
+    if not enabled:
+        return iterable
+    return _timed_iterator(name, iter(iterable))
+
+
+def _timed_iterator(name: str, iterator: Iterator[T]) -> Iterator[T]:
+    total = 0.0
+    try:
+        while True:
+            started = perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                total += perf_counter() - started
+            yield item
+    finally:
+        observe(name + "_seconds", total)
+
+
+def snapshot() -> dict:
+    return {
+        "counters": dict(_counters),
+        "summaries": {
+            name: {"count": i[0], "sum": i[1], "min": i[2], "max": i[3]} for name, i in _summaries.items()
+        }
+    }
+
+
+def pop_snapshot() -> dict | None:
+    """Take the metrics collected so far and reset them. Meant to be called at the end of a worker's task"""
+    if not enabled:
+        return None
+    result = snapshot()
+    reset()
+    return result
+
+
+def merge(other: dict | None):
+    if not enabled or not other:
+        return
+    for name, value in other["counters"].items():
+        _counters[name] = _counters.get(name, 0) + value
+    for name, other_summary in other["summaries"].items():
+        summary = _summaries.get(name)
+        if summary is None:
+            _summaries[name] = [other_summary[i] for i in ("count", "sum", "min", "max")]
+        else:
+            summary[0] += other_summary["count"]
+            summary[1] += other_summary["sum"]
+            summary[2] = min(summary[2], other_summary["min"])
+            summary[3] = max(summary[3], other_summary["max"])
+
+
+def export_json() -> str:
+    return json.dumps(snapshot(), indent=4)
+
+
+def export_prometheus() -> str:
+    """Prometheus text exposition format, the summaries' min and max are exported as gauges"""
+    lines = []
+    for name, value in sorted(_counters.items()):
+        lines += [f"# TYPE {PROMETHEUS_PREFIX}{name}_total counter", f"{PROMETHEUS_PREFIX}{name}_total {value}"]
+    for name, (summary_count, summary_sum, summary_min, summary_max) in sorted(_summaries.items()):
+        full_name = PROMETHEUS_PREFIX + name
+        lines += [
+            f"# TYPE {full_name} summary", f"{full_name}_count {summary_count}", f"{full_name}_sum {summary_sum}",
+            f"# TYPE {full_name}_min gauge", f"{full_name}_min {summary_min}",
+            f"# TYPE {full_name}_max gauge", f"{full_name}_max {summary_max}"
+        ]
+    return "\n".join(lines) + "\n"
+
+
+def export_to_file(path: str):
+    """Files ending with .prom or .txt get the Prometheus format, the other ones get JSON"""
+    with open(path, 'w') as file:
+        file.write(export_prometheus() if path.endswith((".prom", ".txt")) else export_json())
@@ -1,4 +1,7 @@
 from math import log2, ceil
+from typing import Final
+
+import numpy as np
 from matplotlib import pyplot as plt
 from mpl_toolkits.basemap import Basemap
 
@@ -7,6 +10,10 @@ from repository.parking_locations_repository import get_map_corners
 from repository import Location, EPSILON
 
 
+# the curve is linear between its breakpoints, so the points are only needed for the plot to look smooth
+PREDICTION_FUNCTION_POINTS: Final = 512
+
+
 def _configure_locations_plt(use_high_resolution: bool = False, disable_axes: bool = False):
     plt.figure(
         'Current location and the "history" of this area',
@@ -24,10 +31,12 @@ def draw_prediction_function(start: int, prediction: TheftProbabilityPrediction,
         raise ValueError("The 'start' can't be less than 1")
     plt.figure("Linear regression of the theft probability, depending on time", (16, 4))
     if prediction.regression_params is not None:
-        end = ceil((1.0 - prediction.regression_params.b) * 1.05 / prediction.regression_params.a)
-        x = [*range(start, end + 1)]
-        y = [prediction.probability_function(i) for i in x]
-        plt.plot([i / 3600 for i in x], y)
+        a, b = prediction.regression_params.a, prediction.regression_params.b
+        end = max(ceil((1.0 - b) * 1.05 / a), start)
+        # the points where the curve reaches 0 and 1
+        breakpoints = [i for i in (-b / a, (1.0 - b) / a) if start < i < end]
+        x = np.unique(np.concatenate((np.linspace(start, end, PREDICTION_FUNCTION_POINTS), breakpoints)))
+        plt.plot(x / 3600, prediction.probability_function(x))
     plt.xlabel("Time (in hours)")
     plt.ylabel("Risk of a theft (from 0 to 1)")
     plt.title("This is how a theft probability changes here depending on parking time" + (